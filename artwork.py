@@ -2,6 +2,11 @@ import os
 import logging
 import subprocess
 import sqlite3
+import zipfile
+from cache import *
+from flacmeta import *
+from folderindex import *
+from stats import *
 
 
 def geometry(w, h, x=0, y=0):
@@ -11,18 +16,142 @@ def geometry(w, h, x=0, y=0):
         return str(w)+'x'+str(h)+'+'+str(x)+'+'+str(y)
 
 
-def find(rootdir, matchfn):
-    return [os.path.join(root, name)
-            for root, dirs, files in os.walk(rootdir)
-            for name in files if matchfn(name)]
+def link_file(pathname, outfile):
+    # Hard link if on the same filesystem, else a clone (or a copy)
+    try:
+        os.link(pathname, outfile)
+    except OSError:
+        clone_file(pathname, outfile)
 
 
-def by_ext(ext):
-    return lambda name: name.lower().endswith(ext)
+# Already compressed: stored as is in Artwork.zip, deflate would only spend
+# cpu on them (bmp and tiff scans are deflated)
+ZIP_STORED_TYPES = ('.jpg', '.jpeg', '.png', '.pdf')
 
 
-def by_name(name2):
-    return lambda name: name == name2
+def zip_names(pathnames):
+    # Names in the zip of pathnames, without their path (as zip -j).  A name
+    # already taken (case insensitive) gets a number, e.g., 'front (2).jpg',
+    # in the order of pathnames
+    names = []
+    taken = set()
+    for pathname in pathnames:
+        stem, ext = os.path.splitext(os.path.basename(pathname))
+        name = stem + ext
+        n = 1
+        while name.lower() in taken:
+            n += 1
+            name = '%s (%d)%s' % (stem, n, ext)
+        taken.add(name.lower())
+        names.append(name)
+    return names
+
+
+def write_zip(zipname, pathnames):
+    # Create zipname with the files in pathnames (see zip_names).  They are
+    # read and compressed by chunks, one at a time: the memory used does not
+    # depend on their number or size
+    with zipfile.ZipFile(zipname, 'w', allowZip64=True,
+                         strict_timestamps=False) as zf:
+        for pathname, name in zip(pathnames, zip_names(pathnames)):
+            if os.path.splitext(name)[1].lower() in ZIP_STORED_TYPES:
+                compress_type = zipfile.ZIP_STORED
+            else:
+                compress_type = zipfile.ZIP_DEFLATED
+            zf.write(pathname, name, compress_type=compress_type)
+
+
+def jpeg_size(f):
+    # Walk the markers up to the start of frame (SOFn) holding the size
+    f.seek(2)
+    while True:
+        b = f.read(1)
+        if not b:
+            return None
+        if b != b'\xff':
+            continue
+        marker = f.read(1)
+        while marker == b'\xff':
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker in (0x00, 0x01) or 0xd0 <= marker <= 0xd8:
+            # no segment data
+            continue
+        length = int.from_bytes(f.read(2), 'big')
+        if marker in (0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7,
+                      0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf):
+            data = f.read(5)
+            height = int.from_bytes(data[1:3], 'big')
+            width = int.from_bytes(data[3:5], 'big')
+            return [('JPEG', width, height)] if width and height else None
+        if marker == 0xd9 or length < 2:
+            return None
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def tiff_sizes(f, order):
+    # One frame per image file directory (IFD) like identify reports
+    def read(n):
+        data = f.read(n)
+        if len(data) != n:
+            raise ValueError('truncated tiff')
+        return int.from_bytes(data, order)
+    f.seek(4)
+    offset = read(4)
+    sizes = []
+    seen = set()
+    while offset and offset not in seen and len(seen) < 1024:
+        seen.add(offset)
+        f.seek(offset)
+        width = height = None
+        for i in range(read(2)):
+            tag, type, count = read(2), read(2), read(4)
+            if type == 3:
+                # SHORT values are left-justified in the 4-byte value field
+                value = read(2)
+                f.seek(2, os.SEEK_CUR)
+            else:
+                value = read(4)
+            if tag == 256:
+                width = value
+            elif tag == 257:
+                height = value
+        if not (width and height):
+            return None
+        sizes.append(('TIFF', width, height))
+        offset = read(4)
+    return sizes or None
+
+
+def read_image_header(pathname):
+    # Returns the (encoding, width, height) of each frame in pathname, as
+    # identify %m %w %h would, or None for a format we do not handle
+    with open(pathname, 'rb') as f:
+        head = f.read(26)
+        if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+            return [('PNG', int.from_bytes(head[16:20], 'big'),
+                     int.from_bytes(head[20:24], 'big'))]
+        if head[:3] == b'\xff\xd8\xff':
+            return jpeg_size(f)
+        if head[:2] == b'BM' and len(head) == 26:
+            size = int.from_bytes(head[14:18], 'little')
+            if size == 12:
+                # OS/2 bitmap (BITMAPCOREHEADER)
+                return [('BMP2', int.from_bytes(head[18:20], 'little'),
+                         int.from_bytes(head[20:22], 'little'))]
+            f.seek(18)
+            data = f.read(8)
+            width = int.from_bytes(data[0:4], 'little', signed=True)
+            # negative height for top-down bitmaps
+            height = abs(int.from_bytes(data[4:8], 'little', signed=True))
+            return [('BMP3' if size == 40 else 'BMP', width, height)]
+        if head[:4] == b'II*\x00':
+            return tiff_sizes(f, 'little')
+        if head[:4] == b'MM\x00*':
+            return tiff_sizes(f, 'big')
+    return None
 
 
 def cover_search_queries():
@@ -78,7 +207,10 @@ def cover_search_queries():
 
 class coverart_processor:
 
-    def __init__(self):
+    def __init__(self, cache=True):
+        # Picture sizes persist across runs (see cache.py)
+        self.cache = filecache('picture', cache)
+        self.db = None
         # default settings for possible override
         self.blacklist = ('*test*', 'prevdr', 'frequency', 'eac', 'tau',
                 'eac *', 'obi*')
@@ -87,12 +219,54 @@ class coverart_processor:
         self.zipname = 'Artwork'
 
 
-    def probe(self, directory):
+    def probe(self, directory, index=None):
         self.directory = directory
-        self.picfiles = find(directory, by_ext(self.pictypes))
+        if index is None:
+            index = folderindex(directory)
+        self.index = index
+        self.picfiles = self.index.find(self.pictypes)
+        # The picture database and results are built once per probe, then
+        # reused for any other output folder of the same source
+        if self.db:
+            self.db.close()
+        self.db = None
+        self.results = None
         return self.picfiles
 
 
+    def _identify(self, picfile):
+        # Returns the rows of picfile for the picture database: one per frame
+        # with name, pathname, encoding, width and height
+        name = os.path.splitext(os.path.basename(picfile))[0]
+        st = self.index.stat(picfile)
+        sizes = self.cache.get(picfile, st)
+        if sizes is None:
+            sizes = self._picture_sizes(picfile)
+            self.cache.put(picfile, sizes, st)
+        return [[name, picfile, encoding, width, height]
+                for encoding, width, height in sizes]
+
+
+    def _picture_sizes(self, picfile):
+        # Returns (encoding, width, height) of each frame of picfile
+        try:
+            sizes = read_image_header(picfile)
+        except (OSError, ValueError) as e:
+            logging.debug(picfile + ': ' + str(e))
+            sizes = None
+        if sizes:
+            return sizes
+        # Format not handled natively: ask ImageMagick
+        try:
+            output = measured_check_output(['identify','-format','%m\t%w\t%h\n',picfile]).decode('utf8')
+        except subprocess.CalledProcessError as e:
+            print(e.output)
+            return []
+        sizes = [line.split('\t') for line in output.split('\n') if line]
+        return [(encoding, int(width), int(height))
+                for encoding, width, height in sizes]
+
+
     def _create_pic_database(self):
         # Create a picture database to search for cover art candidates
         db = sqlite3.connect(':memory:')
@@ -100,24 +274,31 @@ class coverart_processor:
         cur.execute('''CREATE TABLE picts (name TEXT, pathname TEXT, encoding TEXT,
                     width INTEGER, height INTEGER, ratio FLOAT)''')
         for picfile in self.picfiles:
-            try:
-                output = subprocess.check_output(['identify','-format','%t\t%d/%f\t%m\t%w\t%h\n',picfile]).decode('utf8')
-            except subprocess.CalledProcessError as e:
-                print(e.output)
-            else:
-                lines = output.split('\n')
-                for line in lines:
-                    if line:
-                        row = line.split('\t')
-                        row[0]=row[0].lower() # fix a case-sensitive problem with mysql
-                        row.append(int(row[3]) / float(row[4])) # compute ratio to simply queries
-                        cur.execute('INSERT INTO Picts VALUES(?,?,?,?,?,?)', row)
-                db.commit()
+            for row in self._identify(picfile):
+                row[0]=row[0].lower() # fix a case-sensitive problem with mysql
+                row.append(int(row[3]) / float(row[4])) # compute ratio to simply queries
+                cur.execute('INSERT INTO Picts VALUES(?,?,?,?,?,?)', row)
+            db.commit()
+        self.cache.flush()
         return db
 
 
+    def _link_to(self, outdir):
+        # Same artwork as already produced for another output folder
+        cover, zipname = self.results
+        for pathname in (cover, zipname):
+            if pathname and os.path.exists(pathname):
+                link_file(pathname,
+                          os.path.join(outdir, os.path.basename(pathname)))
+        return os.path.join(outdir, self.covername) if cover else None
+
+
     def extract_to(self, outdir):
-        db = self._create_pic_database()
+        if self.results is not None:
+            return self._link_to(outdir)
+        if self.db is None:
+            self.db = self._create_pic_database()
+        db = self.db
         cur = db.cursor()
         for idx, query in enumerate(cover_search_queries()):
             cur.execute(
@@ -131,7 +312,7 @@ class coverart_processor:
             cover = outdir+'/'+self.covername
             break
         else:
-            db.close()
+            self.results = (None, None)
             return None
 
         if encoding == 'JPEG' and ratio > 0.95 and ratio < 1.05 and width >= 400 and width <= 800:
@@ -170,26 +351,25 @@ class coverart_processor:
             newlength = min(length, 720)
             cmd = ['convert'] + rotate + ['-extract', geometry(length,length,xpos,ypos),
                   '-resize', geometry(newlength,newlength), '-strip', pathname, cover]
-        subprocess.call(cmd)
+        measured_call(cmd)
 
         # Ensure reprocessing already processed folder gives identity
-        Artworkzip = find(self.directory, by_name(self.zipname+'.zip'))
+        Artworkzip = self.index.find_name(self.zipname+'.zip')
         if Artworkzip:
-            cmd = ['cp', Artworkzip[0], outdir]
+            measured_call(['cp', Artworkzip[0], outdir])
         else:
-            pdffiles = find(self.directory, by_ext('.pdf'))
+            pdffiles = self.index.find(('.pdf',))
             # Create a zip file will all pictures (ignore original path)
             # Blacklist some file names, as they are not artwork
             query = "name NOT LIKE '" + "' AND name NOT LIKE '".join(self.blacklist) + "'"
             query = query.replace('*','%')
             logging.debug(query)
-            cur.execute('SELECT pathname FROM picts WHERE '+query+' ORDER BY pathname')
-            # TODO: prevent duplicate names
-            cmd = ['zip', '-j', outdir+'/'+self.zipname] + [pathname for pathname, in cur.fetchall()] + pdffiles
-
-        subprocess.call(cmd)
+            # One row per frame: a multi-frame tiff is there several times
+            cur.execute('SELECT DISTINCT pathname FROM picts WHERE '+query+' ORDER BY pathname')
+            write_zip(os.path.join(outdir, self.zipname + '.zip'),
+                      [pathname for pathname, in cur.fetchall()] + pdffiles)
 
-        db.close()
+        self.results = (cover, os.path.join(outdir, self.zipname + '.zip'))
         return cover
 
 
@@ -0,0 +1,228 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+from metautils import *
+from flacmeta import *
+from folderindex import *
+from flac import *
+from cue import *
+from artwork import *
+from encoder import *
+import testset
+
+# Time of each stage of slickzik on the fixtures of testset.py (generated if
+# missing), best of --repeat runs.  Stages needing a tool that is not
+# installed (flac, sox, a dff2raw build) are skipped.  --save keeps the
+# results, --baseline compares with saved ones to catch regressions.
+# Stages writing flac files also give their size, relative to the source
+
+
+def tool(name):
+    return shutil.which(name) or (os.path.exists(name) and
+                                  os.path.abspath(name))
+
+
+def audio_size(folder, exts=('.flac', '.wav')):
+    index = folderindex(folder)
+    return sum([index.stat(p).st_size for p in index.find(exts)])
+
+
+def stage_probe(fixtures, tmpdir):
+    # Folder scan and probe by all the transcoders (as process_folder does)
+    files = 0
+    args = {'cuecharset': 'iso-8859-1'}
+    for folder in fixtures.values():
+        index = folderindex(folder)
+        flactranscoder(args).probe(folder, index)
+        cuetranscoder(args).probe(folder, index)
+        coverart_processor(cache=False).probe(folder, index)
+        files += len(index.entries)
+    return files, 'files'
+
+
+def stage_metadata(fixtures, tmpdir):
+    # Flac headers and tags, cue sheets
+    files = 0
+    for name in ('cd', 'hr', 'mixed', 'dop'):
+        t = flactranscoder()
+        files += len(t.probe(fixtures[name]))
+        t._extract_metadata()
+    with open(os.path.join(fixtures['cue'], 'image.cue')) as f:
+        cuesheet = f.read()
+    get_cue_metadata(cuesheet)
+    parse_cue_tracks(cuesheet)
+    return files + 1, 'files'
+
+
+def stage_tag(fixtures, tmpdir):
+    # Retag copies of the flac files in place, twice: the second time the
+    # padding left by the first one is reused
+    outdir = os.path.join(tmpdir, 'tag')
+    shutil.copytree(fixtures['cd'], outdir)
+    files = folderindex(outdir).find(('.flac',))
+    for pathname in files:
+        metadata = {k: v for k, v in get_meta(pathname).items()
+                    if isinstance(v, str)}
+        set_meta(dict(metadata, comment='benchmark'), pathname)
+        set_meta(metadata, pathname)
+    return 2 * len(files), 'files'
+
+
+def stage_copy(fixtures, tmpdir):
+    # Flac copied as is with new tags (no dsp, no reencode)
+    t = flactranscoder({'srate': 48000, 'rootdir': tmpdir, 'mix': False,
+                        'gain': 0, 'pipelines': 4, 'reencode': False})
+    t.probe(fixtures['cd'])
+    t.transcode()
+    return audio_size(fixtures['cd']) / 1e6, 'MB'
+
+
+def encode_stage(preset):
+    # flac encode of a CD quality album with one of ENCODER_PRESETS
+    def stage(fixtures, tmpdir):
+        t = flactranscoder({'srate': 48000, 'rootdir': tmpdir, 'mix': False,
+                            'gain': 0, 'pipelines': 4, 'reencode': True,
+                            'preset': preset})
+        t.probe(fixtures['cd'])
+        t.transcode()
+        size = audio_size(fixtures['cd'])
+        return size / 1e6, 'MB', audio_size(tmpdir) / size
+    return stage
+
+
+def stage_rate(fixtures, tmpdir):
+    # sox downsampling of a 96 kHz album + flac -8
+    t = flactranscoder({'srate': 48000, 'rootdir': tmpdir, 'mix': False,
+                        'gain': 0, 'pipelines': 4, 'reencode': False})
+    t.probe(fixtures['hr'])
+    t.transcode()
+    return audio_size(fixtures['hr']) / 1e6, 'MB'
+
+
+def stage_split(fixtures, tmpdir):
+    # wav image split into flac tracks
+    t = cuetranscoder({'rootdir': tmpdir, 'cuecharset': 'iso-8859-1',
+                       't': None, 'pipelines': 4})
+    t.probe(fixtures['cue'])
+    t.transcode()
+    return audio_size(fixtures['cue']) / 1e6, 'MB'
+
+
+def stage_artwork(fixtures, tmpdir):
+    # Picture headers of the scans and search of the cover (the cover itself
+    # and the zip are only made with ImageMagick installed)
+    a = coverart_processor(cache=False)
+    pictures = a.probe(fixtures['art'])
+    if tool('convert'):
+        a.extract_to(tmpdir)
+    else:
+        a.db = a._create_pic_database()
+    return len(pictures), 'pictures'
+
+
+def stage_zip(fixtures, tmpdir):
+    # Artwork.zip of all the scans (see write_zip)
+    pathnames = folderindex(fixtures['art']).find(
+        ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.pdf'))
+    zipname = os.path.join(tmpdir, 'Artwork.zip')
+    write_zip(zipname, pathnames)
+    size = sum([os.path.getsize(p) for p in pathnames])
+    return size / 1e6, 'MB', os.path.getsize(zipname) / size
+
+
+def dff2raw_stage(options):
+    def stage(fixtures, tmpdir):
+        dff = os.path.join(fixtures['dff'], 'stereo.dff')
+        with open(dff, 'rb') as fin, open(os.devnull, 'wb') as null:
+            subprocess.check_call([tool('dff2raw/dff2raw')] + options,
+                                  stdin=fin, stdout=null)
+        return os.path.getsize(dff) / 1e6, 'MB'
+    return stage
+
+
+# name, function, tools needed
+STAGES = [
+    ('probe', stage_probe, ()),
+    ('metadata', stage_metadata, ()),
+    ('tag', stage_tag, ()),
+    ('copy', stage_copy, ()),
+    ('encode', encode_stage('max'), ('flac',)),
+    ('encode balanced', encode_stage('balanced'), ('flac',)),
+    ('encode fast', encode_stage('fast'), ('flac',)),
+    ('rate', stage_rate, ('flac', 'sox')),
+    ('split', stage_split, ('flac',)),
+    ('artwork', stage_artwork, ()),
+    ('zip', stage_zip, ()),
+    ('dff2raw', dff2raw_stage([]), ('dff2raw/dff2raw',)),
+    ('dff2raw -d', dff2raw_stage(['-d']), ('dff2raw/dff2raw',)),
+]
+
+
+def run(stage, fixtures, repeat):
+    best = None
+    for i in range(repeat):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            start = time.perf_counter()
+            result = stage(fixtures, tmpdir)
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    # amount, unit[, size of the output relative to the input]
+    return {'seconds': best, 'amount': result[0], 'unit': result[1],
+            'size': result[2] if len(result) > 2 else None}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the stages of slickzik')
+    parser.add_argument('-t', '--testset', default='testset',
+                        help='fixtures folder (see testset.py)')
+    parser.add_argument('-n', '--repeat', type=int, default=3)
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results to FILE (json)')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare with results saved by --save')
+    parser.add_argument('stages', nargs='*', metavar='stage',
+                        help='stages to run (default: all) among ' +
+                        ', '.join([name for name, f, tools in STAGES]))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    fixtures = {name: os.path.join(args.testset, name) for name in
+                ('cd', 'hr', 'mixed', 'cue', 'cueflac', 'dop', 'dff', 'art')}
+    if not all([os.path.isdir(folder) for folder in fixtures.values()]):
+        print('Generating ' + args.testset)
+        fixtures = testset.generate(args.testset, 20)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    print('%-16s  %8s  %16s  %6s  %s' % ('stage', 'seconds', 'throughput',
+                                         'size', 'baseline'))
+    for name, stage, tools in STAGES:
+        if args.stages and name not in args.stages:
+            continue
+        missing = [t for t in tools if not tool(t)]
+        if missing:
+            print('%-16s  skipped (no %s)' % (name, ', '.join(missing)))
+            continue
+        r = results[name] = run(stage, fixtures, args.repeat)
+        throughput = '%.1f %s/s' % (r['amount'] / r['seconds'], r['unit'])
+        compare = ''
+        if name in baseline:
+            # > 1 is faster than the baseline
+            compare = '%.2fx' % (baseline[name]['seconds'] / r['seconds'])
+        size = '%.1f%%' % (100 * r['size']) if r['size'] else ''
+        print('%-16s  %8.3f  %16s  %6s  %s' % (name, r['seconds'],
+                                               throughput, size, compare))
+        sys.stdout.flush()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
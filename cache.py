@@ -0,0 +1,86 @@
+import os
+import json
+import sqlite3
+import logging
+
+
+def cache_pathname():
+    cachedir = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cachedir, 'slickzik', 'cache.db')
+
+
+def clear_cache():
+    try:
+        os.remove(cache_pathname())
+    except FileNotFoundError:
+        pass
+
+
+class filecache:
+    # Persistent store of data derived from files (e.g., parsed sacd info)
+    # Entries are keyed by path, size and mtime of the file so that they are
+    # invalidated as soon as the file changes
+
+    def __init__(self, kind, enabled=True):
+        self.kind = kind
+        self.enabled = enabled
+        # Connect on first use: sqlite connections must not cross a fork()
+        self.db = None
+
+    def _connect(self):
+        if self.db is None:
+            pathname = cache_pathname()
+            os.makedirs(os.path.dirname(pathname), exist_ok=True)
+            # concurrent workers may share the file: wait for their locks
+            self.db = sqlite3.connect(pathname, timeout=60)
+            self.db.execute('''CREATE TABLE IF NOT EXISTS files (
+                            kind TEXT, pathname TEXT, size INTEGER,
+                            mtime INTEGER, data TEXT,
+                            PRIMARY KEY (kind, pathname))''')
+        return self.db
+
+    def _key(self, pathname, st):
+        if st is None:
+            st = os.stat(pathname)
+        return os.path.realpath(pathname), st.st_size, st.st_mtime_ns
+
+    def get(self, pathname, st=None):
+        # st: stat result of pathname, if already known (see folderindex.py)
+        if not self.enabled:
+            return None
+        pathname, size, mtime = self._key(pathname, st)
+        try:
+            row = self._connect().execute(
+                'SELECT data FROM files WHERE kind=? AND pathname=? '
+                'AND size=? AND mtime=?',
+                (self.kind, pathname, size, mtime)).fetchone()
+        except sqlite3.Error as e:
+            logging.warning('Cache disabled: ' + str(e))
+            self.enabled = False
+            return None
+        return json.loads(row[0]) if row else None
+
+    def put(self, pathname, data, st=None):
+        # st: same as get.  Not committed until flush()
+        if not self.enabled:
+            return
+        pathname, size, mtime = self._key(pathname, st)
+        try:
+            self._connect().execute(
+                'INSERT OR REPLACE INTO files VALUES(?,?,?,?,?)',
+                (self.kind, pathname, size, mtime, json.dumps(data)))
+        except sqlite3.Error as e:
+            logging.warning('Cache disabled: ' + str(e))
+            self.enabled = False
+
+    def flush(self):
+        # Commits the entries put since the last flush: once per folder, not
+        # per file (see probe of the processors)
+        if self.db is None or not self.db.in_transaction:
+            return
+        try:
+            self.db.commit()
+        except sqlite3.Error as e:
+            logging.warning('Cache disabled: ' + str(e))
+            self.enabled = False
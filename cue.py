@@ -2,14 +2,16 @@ import os
 import subprocess
 import logging
 import re
-import tempfile
 import sys
+import asyncio
 from metautils import *
-
-
-def convert_to_flac(sndfile, flacfile):
-    cmd = ['ffmpeg', '-v', 'quiet', '-y', '-i', sndfile, flacfile]
-    subprocess.check_call(cmd)
+from manifest import *
+from plan import *
+from folderindex import *
+from stats import *
+from encoder import *
+from pipeline import *
+from replaygain import *
 
 
 def get_cue_metadata(cuesheet):
@@ -32,61 +34,334 @@ def get_cue_metadata(cuesheet):
     return metadata
 
 
-def filter_cue(cuesheet):
-    # Filter cuedata to get INDEX 01 of each song
-    # and also workaround shnsplit parsing defects/limitations
-    # sed -ni '/TRACK/p; /TITLE/p; /INDEX 01/p' "$CUEFILEUTF"
-    matches = re.findall(
-        r'^(\s*(?:TRACK|PERFORMER|TITLE|INDEX 01).*)$', cuesheet, flags=re.MULTILINE)
-    '''
-    # Non integrated code to handle non-CD cue in shnsplit
-    # shnsplit does not allow the use of frames in non-CD cue -> translate
-    print(matches)
-    for i, line in enumerate(matches):
-        # translate mm:ss:ff (ff = frames 1/75s) to mm:ss:nnn (nnn = 1/1000s)
-        match = re.match(
-            r'(\s+INDEX 01\s+\d{2}:\d{2}:)(\d{2})(?=[^\d])', line)
+# Max bytes of decoded audio waiting to be written to the track encoders, per
+# encoder running at the same time (limit)
+SPLIT_BUFFER_SIZE = 8 * 1024 * 1024
+SPLIT_CHUNK_SIZE = 1024 * 1024
+
+
+def parse_cue_tracks(cuesheet):
+    # Returns the tracks: number, title and start (INDEX 01) in CD frames
+    tracks = []
+    for line in cuesheet.splitlines():
+        match = re.match(r'\s*TRACK\s+(\d+)', line)
         if match:
-            matches[i] = match.group(1) + \
-                ("%03d" % (1000*int(match.group(2))/75.+0.5))
-    # TODO: Second, shnsplit does not cope well with > 44.1k sampling rate
-    # and is failing on the last track
-    # workaround consists of adding a track for ~ last sample
-    # metaflac --show-total-samples
-    # divide by srate and convert to mm:ss:nnn
-    print(matches)
-    '''
-    return '\n'.join(matches)
-
-
-def cuesplit(sndfile, outdir, cuesheet, metadata):
-    cuedata = filter_cue(cuesheet)
-    # Execute shnsplit in outdir to declutter the log
-    # Need to make input path absolute
-    cmd = ['shnsplit', '-o', 'flac flac -8 -s - -o %f',
-           '-n', '%02d', '-t', '%n - %t', '-P', 'none',
-           os.path.realpath(sndfile)]
-    p = subprocess.Popen(
-        cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE, cwd=outdir)
-    output = p.communicate(input=cuedata.encode())
-    # TODO: have a pipeline instead to access flac files as they are created
-    flacfiles = re.findall(r'--> \[(.*.flac)\].* : OK', output[1].decode())
-    logging.debug(flacfiles)
-    if not flacfiles:
-        logging.error('Unexpected result splitting CUE file')
-        logging.debug(output[0])
-        logging.debug(output[1])
+            tracks.append(
+                {'number': int(match.group(1)), 'title': None, 'start': None})
+        elif tracks:
+            match = re.match(r'\s*TITLE\s*"([^"]*)"', line)
+            if match:
+                tracks[-1]['title'] = match.group(1)
+            match = re.match(r'\s*INDEX\s+01\s+(\d+):(\d+):(\d+)', line)
+            if match:
+                mm, ss, ff = [int(v) for v in match.groups()]
+                tracks[-1]['start'] = (mm * 60 + ss) * 75 + ff
+    return [track for track in tracks if track['start'] is not None]
+
+
+def split_points(tracks, srate):
+    # Sample-accurate (start, end) of the tracks, with end=None for the last
+    # A CD frame is 1/75 s: a whole number of samples at all usual rates
+    starts = [track['start'] * srate // 75 for track in tracks]
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def read_wav_header(pathname):
+    # Returns channels, bps, srate and the offset and size of the pcm data
+    with open(pathname, 'rb') as f:
+        header = f.read(12)
+        if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            raise ValueError(pathname + ': not a wav file')
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) != 8:
+                raise ValueError(pathname + ': no wav data')
+            size = int.from_bytes(header[4:8], 'little')
+            if header[:4] == b'fmt ':
+                data = f.read(size + (size & 1))
+                tag = int.from_bytes(data[0:2], 'little')
+                if tag == 0xfffe:
+                    # WAVE_FORMAT_EXTENSIBLE: actual format in the sub-type
+                    tag = int.from_bytes(data[24:26], 'little')
+                fmt = {'channels': int.from_bytes(data[2:4], 'little'),
+                       'srate': int.from_bytes(data[4:8], 'little'),
+                       'bps': int.from_bytes(data[14:16], 'little')}
+                align = int.from_bytes(data[12:14], 'little')
+                if tag != 1 or align != fmt['channels'] * fmt['bps'] // 8:
+                    raise ValueError(pathname + ': unsupported wav format')
+            elif header[:4] == b'data' and fmt:
+                fmt['offset'] = f.tell()
+                # streamed wav files do not know their data size
+                fmt['size'] = size if size not in (0, 0xffffffff) else None
+                return fmt
+            else:
+                f.seek(size + (size & 1), os.SEEK_CUR)
+
+
+def probe_ffmpeg_format(sndfile):
+    # Format of the first audio stream of files we let ffmpeg decode
+    cmd = ['ffprobe', '-v', 'quiet', '-select_streams', 'a:0',
+           '-show_entries',
+           'stream=channels,sample_rate,sample_fmt,bits_per_raw_sample,'
+           'duration',
+           '-of', 'default=noprint_wrappers=1', sndfile]
+    logging.debug(cmd)
+    output = measured_check_output(cmd).decode()
+    info = dict(re.findall(r'^(\w+)=(.*?)\s*$', output, re.MULTILINE))
+    if info.get('bits_per_raw_sample', '').isdigit() and \
+            int(info['bits_per_raw_sample']) in (8, 16, 24):
+        bps = int(info['bits_per_raw_sample'])
+    elif info.get('sample_fmt', '').startswith('u8'):
+        bps = 8
+    elif info.get('sample_fmt', '').startswith('s16'):
+        bps = 16
+    else:
+        bps = 24
+    fmt = {'channels': int(info['channels']),
+           'srate': int(info['sample_rate']), 'bps': bps}
+    try:
+        fmt['samples'] = int(float(info['duration']) * fmt['srate'])
+    except (KeyError, ValueError):
+        pass
+    return fmt
+
+
+def get_pcm_format(sndfile):
+    if sndfile.lower().endswith('.wav'):
+        return read_wav_header(sndfile)
+    elif sndfile.lower().endswith('.flac'):
+        return read_flac_header(sndfile)
+    else:
+        return probe_ffmpeg_format(sndfile)
+
+
+async def open_pcm(sndfile, fmt, skip, until):
+    # Returns a coroutine function reading the raw pcm of sndfile from sample
+    # skip up to until (None for the end), the decoder process and command
+    # (if any)
+    framesize = fmt['channels'] * fmt['bps'] // 8
+    if sndfile.lower().endswith('.wav'):
+        # wav: no need to decode, read the data chunk
+        loop = asyncio.get_running_loop()
+        f = open(sndfile, 'rb')
+        f.seek(fmt['offset'] + skip * framesize)
+        if until is None and fmt['size'] is not None:
+            until = fmt['size'] // framesize
+        remaining = [None if until is None else (until - skip) * framesize]
+
+        async def read(n):
+            if remaining[0] is not None:
+                n = min(n, remaining[0])
+                remaining[0] -= n
+            if not n or f.closed:
+                return b''
+            data = await loop.run_in_executor(None, f.read, n)
+            if len(data) < n or remaining[0] == 0:
+                f.close()
+            return data
+        return read, None, None
+    if sndfile.lower().endswith('.flac'):
+        # same sign as the encoder reads (8-bit pcm is unsigned)
+        options = ['--skip=' + str(skip)]
+        if until is not None:
+            options += ['--until=' + str(until)]
+        cmd = raw_decoder_cmd(sndfile, fmt, options)
+    else:
+        # ape, wv...: ffmpeg decodes straight into the pipe (no temp file)
+        trim = 'atrim=start_sample=' + str(skip)
+        if until is not None:
+            trim += ':end_sample=' + str(until)
+        pcm = {8: 'u8', 16: 's16le', 24: 's24le'}[fmt['bps']]
+        cmd = ['ffmpeg', '-v', 'quiet', '-i', sndfile, '-map', '0:a:0',
+               '-af', trim, '-f', pcm, '-c:a', 'pcm_' + pcm, '-']
+    logging.debug(cmd)
+    p = await measured_exec(
+        *cmd, stdout=subprocess.PIPE, limit=SPLIT_CHUNK_SIZE)
+    return p.stdout.read, p, cmd
+
+
+class splitbuffer:
+    # Bounds the memory used by decoded audio not yet read by the encoders
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.cond = asyncio.Condition()
+
+    async def acquire(self, n):
+        async with self.cond:
+            await self.cond.wait_for(
+                lambda: self.used == 0 or self.used + n <= self.size)
+            self.used += n
+
+    async def release(self, n):
+        async with self.cond:
+            self.used -= n
+            self.cond.notify_all()
+
+
+async def encode_track(procs, queue, buffer, running, result, finished):
+    # Writes the samples queued for the track to its encoder (the first of
+    # procs, a pipeline)
+    p = procs[0]
+    broken = False
+    while True:
+        data = await queue.get()
+        if data is None:
+            break
+        if not broken:
+            try:
+                p.stdin.write(data)
+                await p.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # encoder died: keep draining the queue, its exit code says why
+                broken = True
+        await buffer.release(len(data))
+    if result['error']:
+        # e.g., truncated: the encoder must not complete a valid-looking file
+        for proc in procs:
+            proc.kill()
+    try:
+        p.stdin.close()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    for p in procs:
+        await p.wait()
+    running.release()
+    returncode = max([p.returncode for p in procs], key=abs)
+    if returncode == 0 and result['error'] is None:
+        if finished:
+            finished(result['pathname'])
     else:
-        for f in flacfiles:
-            pathname = os.path.join(outdir, f)
-            if f == '00 - pregap.flac':
-                os.remove(pathname)
+        if result['error'] is None:
+            result['error'] = 'encoder exit code ' + str(returncode)
+        logging.error('Failed creating\t' + os.path.basename(result['pathname'])
+                      + ' (' + result['error'] + ')')
+        if os.path.exists(result['pathname']):
+            os.remove(result['pathname'])
+
+
+def track_metadata(metadata, track):
+    metadata = dict(metadata)
+    metadata['tracknumber'] = '%02d' % track['number']
+    metadata['title'] = dontshout(track['title'] or 'Unknown Title')
+    return metadata
+
+
+async def split_pcm(sndfile, fmt, outdir, selected, metadata, limit,
+                    encoder, finished=None, rg=None):
+    # Decode sndfile once and feed each track to its own encoder
+    # selected: list of (track, start, end) in sample offsets
+    # rg: if set, albumgain measuring the tracks (see replaygain.py)
+    framesize = fmt['channels'] * fmt['bps'] // 8
+    read, decoder, decoder_cmd = await open_pcm(
+        sndfile, fmt, selected[0][1], selected[-1][2])
+    buffer = splitbuffer(SPLIT_BUFFER_SIZE * max(1, limit))
+    running = asyncio.Semaphore(max(1, limit))
+    encoders = []
+    tasks = []
+    results = []
+    pos = selected[0][1]
+    try:
+        for track, start, end in selected:
+            # Skip unselected tracks
+            remaining = (start - pos) * framesize
+            while remaining > 0:
+                data = await read(min(remaining, SPLIT_CHUNK_SIZE))
+                if not data:
+                    break
+                remaining -= len(data)
+            trackmeta = track_metadata(metadata, track)
+            result = {'tracknumber': trackmeta['tracknumber'],
+                      'title': trackmeta['title'],
+                      'pathname': get_filename(outdir, trackmeta),
+                      'error': None}
+            results.append(result)
+            # Up to limit encoders at the same time
+            await running.acquire()
+            logging.info('Creating\t' + os.path.basename(result['pathname']))
+            if rg:
+                cmds = rg.encoder_cmds(fmt, result['pathname'], trackmeta,
+                                       encoder)
             else:
-                logging.info('Creating\t' + f)
-                metadata['tracknumber'] = infer_tracknumber(f)
-                metadata['title'] = infer_title(f)
-                set_meta(metadata, pathname)
-    return outdir
+                cmds = [raw_encoder_cmd(fmt, result['pathname'], trackmeta,
+                                        encoder)]
+            procs = await start_pipeline(cmds, stdin=subprocess.PIPE,
+                                         track=result['pathname'])
+            encoders += procs
+            queue = asyncio.Queue()
+            tasks.append(asyncio.ensure_future(encode_track(
+                procs, queue, buffer, running, result, finished)))
+            remaining = None if end is None else (end - start) * framesize
+            size = 0
+            while remaining is None or remaining > 0:
+                data = await read(SPLIT_CHUNK_SIZE if remaining is None
+                                  else min(remaining, SPLIT_CHUNK_SIZE))
+                if not data:
+                    break
+                await buffer.acquire(len(data))
+                queue.put_nowait(data)
+                size += len(data)
+                if remaining is not None:
+                    remaining -= len(data)
+            if remaining or not size:
+                # its end (or the whole last track) is past the audio data
+                result['error'] = 'audio data ends before the track'
+            queue.put_nowait(None)
+            pos = end
+        await asyncio.gather(*tasks)
+        if decoder:
+            await decoder.wait()
+            if decoder.returncode != 0:
+                raise subprocess.CalledProcessError(
+                    decoder.returncode, decoder_cmd)
+    finally:
+        for p in encoders + [decoder]:
+            if p and p.returncode is None:
+                p.kill()
+                await p.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return results
+
+
+def cuesplit(sndfile, outdir, cuesheet, metadata, select=None, limit=1,
+             progress=None, encoder=None, rg=None):
+    # Split sndfile into one flac per track of the cue sheet (all tracks or
+    # those whose number is in select) and encode up to limit in parallel
+    # progress: if set, skip its done tracks and record the finished ones
+    # encoder: flacencoder, default preset if not set
+    # rg: if set, albumgain measuring the tracks, done ones included
+    # Returns one result (tracknumber, title, pathname, error) per track
+    fmt = get_pcm_format(sndfile)
+    tracks = parse_cue_tracks(cuesheet)
+    logging.debug(tracks)
+    # Samples before the first track (pregap) are ignored
+    selected = [(track, start, end) for track, (start, end) in
+                zip(tracks, split_points(tracks, fmt['srate']))
+                if (end is None or end > start) and
+                (not select or track['number'] in [int(t) for t in select])]
+    if not selected:
+        logging.error('No track to split in CUE file')
+        return []
+    if progress:
+        outfiles = [get_filename(outdir, track_metadata(metadata, track))
+                    for track, start, end in selected]
+        done = [progress.done(outfile) for outfile in outfiles]
+        selected = [s for s, d in zip(selected, done) if not d]
+        if rg:
+            run_jobs(rg.missing([outfile for outfile, d in
+                                 zip(outfiles, done) if d]), limit)
+        if not selected:
+            return []
+    results = asyncio.run(split_pcm(
+        sndfile, fmt, outdir, selected, metadata, limit,
+        encoder or flacencoder(), progress.finished if progress else None,
+        rg))
+    logging.debug(results)
+    return results
 
 
 class cuetranscoder:
@@ -96,16 +371,14 @@ class cuetranscoder:
         # self.directory    -> input directory
         # self.files        -> list of (sound file, cue sheet) pairs
 
-    def probe(self, directory):
+    def probe(self, directory, index=None):
         self.directory = directory
         self.files = []
+        if index is None:
+            index = folderindex(directory)
         # Detect file.cue pointing to a single sndfile.(flac|wav|ape|wv))
-        cuefiles = sorted(
-            [name for name in os.listdir(directory)
-                if name.lower().endswith('.cue')])
-        sndfiles = sorted(
-            [name for name in os.listdir(directory)
-                if name.lower().endswith(('.flac', '.wav', '.ape', '.wv'))])
+        cuefiles = index.names(('.cue',))
+        sndfiles = index.names(('.flac', '.wav', '.ape', '.wv'))
         logging.debug('cuefiles=' + str(cuefiles))
         logging.debug('sndfiles=' + str(sndfiles))
         cuepairs = []
@@ -145,7 +418,28 @@ class cuetranscoder:
                 logging.debug('convert=' + sndfile[0])
         return self.files
 
-    def transcode(self):
+    def estimate(self):
+        # Work of transcode() (see plan.py): decode and split into flac
+        estimates = []
+        for sndfile, cuefile in self.files:
+            pathname = os.path.join(self.directory, sndfile)
+            fmt = get_pcm_format(pathname)
+            if 'samples' in fmt:
+                samples = fmt['samples']
+            elif fmt.get('size'):
+                samples = fmt['size'] // (fmt['channels'] * fmt['bps'] // 8)
+            else:
+                # Unknown length: guess from the file size (50% lossless)
+                samples = os.path.getsize(pathname) * 2 // \
+                    (fmt['channels'] * fmt['bps'] // 8)
+            estimates.append(estimate(
+                'cue', samples / fmt['srate'], fmt['channels'], fmt['srate'],
+                'reencode'))
+        return merge_estimates(estimates)
+
+    def transcode(self, progress=None):
+        if progress is None:
+            progress = albumprogress()
         outdirs = []
         for sndfile, cuefile in self.files:
             logging.info('Processing\t' + sndfile)
@@ -153,23 +447,20 @@ class cuetranscoder:
             with open(os.path.join(self.directory, cuefile), 'r', encoding=self.args['cuecharset']) as f:
                 cuesheet = f.read()
             metadata = get_cue_metadata(cuesheet)
-            outdir = get_output_dir(self.args['rootdir'], metadata)
-            os.mkdir(outdir)
+            outdir = progress.make_output_dir(self.args['rootdir'], metadata)
             logging.info('To ' + outdir)
             outdirs.append(outdir)
-            if sndfile.lower().endswith(('.wv', '.ape')):
-                fd, flacfile = tempfile.mkstemp('.flac')
-                # creating a file object from low-level handle fd
-                # closes the handle when the file object is out of scope
-                with os.fdopen(fd) as f:
-                    logging.info('Converting\t' + sndfile)
-                    convert_to_flac(
-                        os.path.join(self.directory, sndfile), flacfile)
-                cuesplit(flacfile, outdir, cuesheet, metadata)
-                os.remove(flacfile)
-            else:
-                flacfile = os.path.join(self.directory, sndfile)
-                cuesplit(flacfile, outdir, cuesheet, metadata)
+            # Any format (flac, wav, ape, wv) is decoded once into the split
+            rg = albumgain() if self.args.get('replaygain') else None
+            results = cuesplit(
+                os.path.join(self.directory, sndfile), outdir, cuesheet,
+                metadata, self.args['t'], self.args['pipelines'], progress,
+                make_encoder(self.args, len(parse_cue_tracks(cuesheet))), rg)
+            for result in results:
+                if result['error']:
+                    progress.failed(result['pathname'])
+            if rg:
+                rg.tag()
         return outdirs
 
 
@@ -177,11 +468,29 @@ if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     logging.info('Test 1')
 
-    args = {'srate':48000, 'rootdir':'.', 'mix':False, 'gain':0, 'cuecharset':'iso-8859-1'}
-    t = transcoder(args)
+    args = {'srate':48000, 'rootdir':'.', 'mix':False, 'gain':0, 'cuecharset':'iso-8859-1',
+            't':None, 'pipelines':4}
+    t = cuetranscoder(args)
     f = t.probe('testset/cue')
     assert f, 'check testset/cue folder for .cue + single large audio file (any format)'
     print(f)
     d = t.transcode()
     assert d, 'transcode did not create output folder'
-    logging.warn('DONE - Test 1. Verify ' + str(d) + ' matches testset/cue')
+    logging.warning('DONE - Test 1. Verify ' + str(d) + ' matches testset/cue')
+
+    logging.info('Test 2')
+    # The INDEX of track 2 is past the end of the audio data: both tracks are
+    # truncated, neither may be left in the output folder
+    import tempfile
+    image = os.path.join('testset/cue', [s for s, c in f][0])
+    cuesheet = ('FILE "%s" WAVE\n  TRACK 01 AUDIO\n    INDEX 01 00:00:00\n'
+                '  TRACK 02 AUDIO\n    INDEX 01 99:00:00\n' %
+                os.path.basename(image))
+    with tempfile.TemporaryDirectory() as outdir:
+        results = cuesplit(image, outdir, cuesheet, {'album': 'Truncated'})
+        assert len(results) == 2, 'expected 2 tracks'
+        for result in results:
+            assert result['error'], 'truncated track not reported'
+            assert not os.path.exists(result['pathname']), \
+                'truncated track left in ' + outdir
+    logging.warning('DONE - Test 2. Truncated tracks reported and removed')
@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+# Throughput of dff2raw (or of several builds of it) on a synthetic DFF file,
+# in MB/s of DSD input.  With --digest, the output digest shows whether builds
+# agree (hashing the output slows down the measure).
+
+
+def chunk(ckid, data):
+    return ckid + len(data).to_bytes(8, 'big') + data
+
+
+def write_dff(f, channels, seconds, srate=2822400):
+    size = srate // 8 * channels * seconds
+    prop = b'SND ' + chunk(b'FS  ', srate.to_bytes(4, 'big')) + \
+        chunk(b'CHNL', channels.to_bytes(2, 'big') + b'SLFT' * channels) + \
+        chunk(b'CMPR', b'DSD \x0enot compressed\x00')
+    header = b'DSD ' + chunk(b'FVER', bytes([1, 5, 0, 0])) + \
+        chunk(b'PROP', prop)
+    f.write(b'FRM8' + (len(header) + 12 + size).to_bytes(8, 'big') + header)
+    f.write(b'DSD ' + size.to_bytes(8, 'big'))
+    block = srate // 8 * channels
+    for i in range(seconds):
+        f.write(os.urandom(block))
+    return size
+
+
+def run(prog, options, dff, repeat, digest):
+    best = None
+    for i in range(repeat):
+        sha1 = hashlib.sha1()
+        start = time.perf_counter()
+        with open(dff, 'rb') as fin, open(os.devnull, 'wb') as null:
+            p = subprocess.Popen([prog] + options, stdin=fin,
+                                 stdout=subprocess.PIPE if digest else null)
+            if digest:
+                for data in iter(lambda: p.stdout.read(1 << 20), b''):
+                    sha1.update(data)
+            if p.wait():
+                sys.exit(prog + ' failed')
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, sha1.hexdigest() if digest else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure dff2raw throughput')
+    parser.add_argument('-c', '--channels', type=int, default=2)
+    parser.add_argument('-s', '--seconds', type=int, default=30)
+    parser.add_argument('-n', '--repeat', type=int, default=3)
+    parser.add_argument('-m', '--mixdown', action='store_true',
+                        help='measure dff2raw -m (needs 5 or 6 channels)')
+    parser.add_argument('--decimate', action='store_true',
+                        help='measure dff2raw -d')
+    parser.add_argument('-d', '--digest', action='store_true',
+                        help='print the sha1 of the output')
+    parser.add_argument('prog', nargs='*', default=['./dff2raw'])
+    args = parser.parse_args()
+    with tempfile.NamedTemporaryFile(suffix='.dff') as f:
+        size = write_dff(f, args.channels, args.seconds)
+        f.flush()
+        for prog in args.prog:
+            options = (['-m'] if args.mixdown else []) + \
+                (['-d'] if args.decimate else [])
+            elapsed, digest = run(prog, options, f.name, args.repeat,
+                                  args.digest)
+            print('%s: %.1f MB/s (%d-ch, %ds)%s' % (
+                prog, size / elapsed / 1e6, args.channels, args.seconds,
+                ' sha1=' + digest if digest else ''))
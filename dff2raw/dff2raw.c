@@ -19,68 +19,327 @@ struct weights {
 
 #define NUM_CHANNELS_MAX (6)
 
-int dsd_unpack_to_float(int numChannels, size_t dataSize, FILE *fin, FILE *fout)
+/* Frames (1 byte per channel) unpacked per fread/fwrite call */
+#define BLOCK_FRAMES (4096)
+
+/* DSD byte -> 8 floats (+1/-1), MSB first */
+static float unpack_lut[256][8];
+
+/* DSD byte -> 8 nibbles, MSB first in nibble 0, each nibble 0 or 1 */
+static uint32_t spread_lut[256];
+
+void init_luts()
+{
+    int b, j;
+
+    for (b = 0; b < 256; ++b) {
+        spread_lut[b] = 0;
+        for (j = 0; j < 8; ++j) {
+            unpack_lut[b][j] = b & (0x80 >> j) ? 1. : -1.;
+            if (b & (0x80 >> j)) {
+                spread_lut[b] |= 1u << (4 * j);
+            }
+        }
+    }
+}
+
+/* Stream mode (-S): the input is a pipe written while the track is being
+   extracted (see sacd.py).  Its header may not give the size of the DSD
+   data (the writer cannot seek back to fix it), so the data runs up to the
+   end of the input, less the chunks written after it (ID3, DIIN, or the
+   header written again): those are looked for in the last TAIL_BYTES */
+#define TAIL_BYTES (65536)
+
+static int stream_mode = 0;
+static uint8_t tail[TAIL_BYTES + BLOCK_FRAMES * NUM_CHANNELS_MAX];
+static size_t tail_len = 0;
+static int tail_eof = 0;
+
+/* True if p[0..len) is a list of chunks (what follows the DSD data) */
+int is_chunk_list(const uint8_t *p, size_t len)
 {
-    float sample[8 * NUM_CHANNELS_MAX];
-    uint8_t ch_byte[NUM_CHANNELS_MAX];
-    uint8_t mask;
-    int i, j, k;
-
-    for (i = 0; i < dataSize / numChannels; ++i) {
-        if (fread(ch_byte, 1, numChannels, fin) != numChannels) {
-            fprintf(stderr, "\n%s - Premature end of file\n", prgname);
+    uint64_t size;
+    int i;
+
+    while (len >= 12) {
+        if (memcmp(p, "FRM8", 4) == 0) {
             return 1;
         }
+        for (i = 0; i < 4; ++i) {
+            if (p[i] < 0x20 || p[i] > 0x7e) {
+                return 0;
+            }
+        }
+        for (size = 0, i = 4; i < 12; ++i) {
+            size = size << 8 | p[i];
+        }
+        size += size & 1;
+        if (size > len - 12) {
+            return 0;
+        }
+        p += 12 + size;
+        len -= 12 + size;
+    }
+    return len == 0;
+}
+
+/* Offset of the chunks at the end of p[0..len), len if none */
+size_t audio_end(const uint8_t *p, size_t len)
+{
+    size_t i;
+
+    for (i = 0; i + 12 <= len; ++i) {
+        if (is_chunk_list(p + i, len - i)) {
+            return i;
+        }
+    }
+    return len;
+}
+
+/* Same as fread, but the bytes after the DSD data are never returned */
+size_t stream_frames(uint8_t *buf, int numChannels, size_t n, FILE *fin)
+{
+    size_t want = n * numChannels;
+    size_t got, avail;
+
+    while (!tail_eof && tail_len < TAIL_BYTES + want) {
+        got = fread(tail + tail_len, 1, TAIL_BYTES + want - tail_len, fin);
+        tail_len += got;
+        if (got == 0) {
+            tail_eof = 1;
+            tail_len = audio_end(tail, tail_len);
+            tail_len -= tail_len % numChannels;
+        }
+    }
+    avail = tail_eof ? tail_len : tail_len - TAIL_BYTES;
+    if (want > avail) {
+        want = avail;
+    }
+    memcpy(buf, tail, want);
+    memmove(tail, tail + want, tail_len - want);
+    tail_len -= want;
+    return want / numChannels;
+}
+
+/* Read up to n frames of numChannels bytes, never past the frames left */
+size_t read_frames(uint8_t *buf, int numChannels, size_t n, FILE *fin)
+{
+    size_t frames;
+
+    if (stream_mode) {
+        /* the end of the input is the end of the data */
+        return stream_frames(buf, numChannels, n, fin);
+    }
+    frames = fread(buf, numChannels, n, fin);
+    if (frames != n) {
+        fprintf(stderr, "\n%s - Premature end of file\n", prgname);
+    }
+    return frames;
+}
+
+int dsd_unpack_to_float(int numChannels, size_t dataSize, FILE *fin, FILE *fout)
+{
+    static uint8_t ch_byte[BLOCK_FRAMES * NUM_CHANNELS_MAX];
+    static float sample[BLOCK_FRAMES * 8 * NUM_CHANNELS_MAX];
+    size_t left = dataSize / numChannels;
+    size_t n, frames, i;
+    float *out;
+    int j, k;
+
+    while (left > 0) {
+        n = left < BLOCK_FRAMES ? left : BLOCK_FRAMES;
+        frames = read_frames(ch_byte, numChannels, n, fin);
         /* Unpack 8 bits of DSD (channel byte) per channel
            into 8 interleaved floats */
-        for (mask = 0x80, j = 0; mask != 0; mask >>= 1, j += numChannels) {
+        for (i = 0; i < frames; ++i) {
+            out = &sample[i * 8 * numChannels];
             for (k = 0; k < numChannels; ++k) {
-                sample[j+k] = ch_byte[k] & mask ? 1. : -1.;
+                const float *lut = unpack_lut[ch_byte[i * numChannels + k]];
+                for (j = 0; j < 8; ++j) {
+                    out[j * numChannels + k] = lut[j];
+                }
             }
         }
-        if (fwrite(sample, sizeof(float) * 8, numChannels, fout) != numChannels) {
+        if (fwrite(sample, sizeof(float) * 8 * numChannels, frames, fout) != frames) {
             fprintf(stderr, "\n%s - Write error\n", prgname);
             return 1;
         }
+        if (frames != n) {
+            return !stream_mode;
+        }
+        left -= n;
     }
     return 0;
 }
-      
+
 
 int dsd_unpack_to_float_mix(int numChannels, size_t dataSize,
                             const struct weights* w, FILE *fin, FILE *fout)
 {
-    float sample[8 * 2]; /* 2 channel output (8 x float samples) */
-    uint8_t ch_byte[NUM_CHANNELS_MAX];
-    uint8_t mask;
+    static uint8_t ch_byte[BLOCK_FRAMES * NUM_CHANNELS_MAX];
+    static float sample[BLOCK_FRAMES * 8 * 2]; /* 2 channel output */
+    float mix[16];
     float mono;
     float gain;
-    int i, j;
+    size_t left = dataSize / numChannels;
+    size_t n, frames, i;
+    const uint8_t *in;
+    float *out;
+    uint32_t l, r;
+    int b, j;
 
     /* 5 ch: 0-Left, 1-Right, 2-Centre, 3-Rear L, 4-Rear R
        6 ch: 0-Left, 1-Right, 2-Centre, 3-Sub, 4-Rear L, 5-Rear R */
     gain = 1./(w->front + w->centre + (numChannels==6 ? w->sub:0.) + w->rear);
-    for (i = 0; i < dataSize / numChannels; ++i) {
-        if (fread(ch_byte, 1, numChannels, fin) != numChannels) {
-            fprintf(stderr, "\n%s - Premature end of file\n", prgname);
-            return 1;
+    /* Each output sample only depends on 4 input bits (front, rear, centre
+       and sub): precompute the 16 possible values, with the same operations
+       in the same order as a sample by sample mix (bit-identical output) */
+    for (b = 0; b < 16; ++b) {
+        mono = b & 2 ? w->centre : -w->centre;
+        if (numChannels == 6) {
+            mono += b & 1 ? w->sub : -w->sub;
         }
-        for (mask = 0x80, j = 0; mask != 0; mask >>= 1, j += 2) {
-            mono = ch_byte[2] & mask ? w->centre : -w->centre;
+        mix[b] = ((b & 8 ? w->front : -w->front)
+                  + (b & 4 ? w->rear : -w->rear)
+                  + mono) * gain;
+    }
+    while (left > 0) {
+        n = left < BLOCK_FRAMES ? left : BLOCK_FRAMES;
+        frames = read_frames(ch_byte, numChannels, n, fin);
+        for (i = 0; i < frames; ++i) {
+            in = &ch_byte[i * numChannels];
+            out = &sample[i * 16];
+            /* nibble j of l (r) = mix index of sample j of left (right) */
+            l = spread_lut[in[2]] << 1 | spread_lut[in[0]] << 3
+                | spread_lut[in[numChannels-2]] << 2;
+            r = spread_lut[in[2]] << 1 | spread_lut[in[1]] << 3
+                | spread_lut[in[numChannels-1]] << 2;
             if (numChannels == 6) {
-                mono += ch_byte[3] & mask ? w->sub : -w->sub;
+                l |= spread_lut[in[3]];
+                r |= spread_lut[in[3]];
+            }
+            for (j = 0; j < 8; ++j, l >>= 4, r >>= 4) {
+                out[2*j] = mix[l & 15];
+                out[2*j+1] = mix[r & 15];
             }
-            sample[j] = ((ch_byte[0] & mask ? w->front : -w->front)
-                         + (ch_byte[numChannels-2] & mask ? w->rear : -w->rear)
-                         + mono) * gain;
-            sample[j+1] = ((ch_byte[1] & mask ? w->front : -w->front)
-                           + (ch_byte[numChannels-1] & mask ? w->rear : -w->rear)
-                           + mono) * gain;
-        }
-        if (fwrite(sample, sizeof(float) * 8, 2, fout) != 2) {
+        }
+        if (fwrite(sample, sizeof(float) * 8 * 2, frames, fout) != frames) {
             fprintf(stderr, "\n%s - Write error\n", prgname);
             return 1;
         }
+        if (frames != n) {
+            return !stream_mode;
+        }
+        left -= n;
+    }
+    return 0;
+}
+
+/* Decimation by 8 (2.8224 MHz -> 352.8 kHz), one output sample per input
+   byte, with a linear phase lowpass FIR of FIR_BYTES * 8 taps.  The FIR is
+   byte-indexed: fir_lut[g][b] is the contribution of byte b at position g
+   of the FIR window, so each output sample costs FIR_BYTES lookups */
+#define DECIMATION (8)
+#define FIR_BYTES (20)
+#define FIR_TAPS (FIR_BYTES * 8)
+#define DSD_SILENCE (0x69)
+
+static float fir_lut[FIR_BYTES][256];
+
+double bessel_i0(double x)
+{
+    double sum = 1., term = 1.;
+    int k;
+
+    for (k = 1; term > sum * 1e-12; ++k) {
+        term *= (x / (2. * k)) * (x / (2. * k));
+        sum += term;
+    }
+    return sum;
+}
+
+void init_fir()
+{
+    /* Kaiser windowed sinc, cut-off at the output Nyquist frequency:
+       flat up to 110 kHz and > 120 dB down from 256.8 kHz (352.8 - 96 kHz),
+       so that DSD noise does not alias into the band kept by sox */
+    const double fc = 0.5 / DECIMATION;
+    const double beta = 12.26;
+    double h[FIR_TAPS];
+    double sum = 0., t, x;
+    int i, g, b, j;
+
+    for (i = 0; i < FIR_TAPS; ++i) {
+        t = i - (FIR_TAPS - 1) / 2.;
+        x = 2. * i / (FIR_TAPS - 1) - 1.;
+        h[i] = (t == 0. ? 2. * fc : sin(2. * M_PI * fc * t) / (M_PI * t))
+               * bessel_i0(beta * sqrt(1. - x * x)) / bessel_i0(beta);
+        sum += h[i];
+    }
+    for (g = 0; g < FIR_BYTES; ++g) {
+        for (b = 0; b < 256; ++b) {
+            x = 0.;
+            for (j = 0; j < 8; ++j) {
+                x += b & (0x80 >> j) ? h[g*8+j] : -h[g*8+j];
+            }
+            /* unity gain at DC, same level as sox rate from 2.8224 MHz */
+            fir_lut[g][b] = x / sum;
+        }
+    }
+}
+
+int dsd_decimate_to_float(int numChannels, size_t dataSize,
+                          const struct weights* w, FILE *fin, FILE *fout)
+{
+    /* FIR window of the first frame of the block, then the block */
+    static uint8_t ch_byte[(FIR_BYTES - 1 + BLOCK_FRAMES) * NUM_CHANNELS_MAX];
+    static float sample[BLOCK_FRAMES * NUM_CHANNELS_MAX];
+    const size_t history = (FIR_BYTES - 1) * numChannels;
+    size_t left = dataSize / numChannels;
+    size_t n, frames, i;
+    int outChannels = w ? 2 : numChannels;
+    float y[NUM_CHANNELS_MAX];
+    float gain = 0.;
+    const uint8_t *in;
+    int g, k;
+
+    if (w) {
+        /* Same weights as dsd_unpack_to_float_mix */
+        gain = 1./(w->front + w->centre + (numChannels==6 ? w->sub:0.) + w->rear);
+    }
+    memset(ch_byte, DSD_SILENCE, history);
+    while (left > 0) {
+        n = left < BLOCK_FRAMES ? left : BLOCK_FRAMES;
+        frames = read_frames(ch_byte + history, numChannels, n, fin);
+        for (i = 0; i < frames; ++i) {
+            in = &ch_byte[i * numChannels];
+            for (k = 0; k < numChannels; ++k) {
+                y[k] = 0.;
+                for (g = 0; g < FIR_BYTES; ++g) {
+                    y[k] += fir_lut[g][in[g * numChannels + k]];
+                }
+            }
+            if (w) {
+                float mono = w->centre * y[2]
+                             + (numChannels == 6 ? w->sub * y[3] : 0.);
+                sample[2*i] = (w->front * y[0] + w->rear * y[numChannels-2]
+                               + mono) * gain;
+                sample[2*i+1] = (w->front * y[1] + w->rear * y[numChannels-1]
+                                 + mono) * gain;
+            }
+            else {
+                memcpy(&sample[i * numChannels], y, sizeof(float) * numChannels);
+            }
+        }
+        if (fwrite(sample, sizeof(float) * outChannels, frames, fout) != frames) {
+            fprintf(stderr, "\n%s - Write error\n", prgname);
+            return 1;
+        }
+        if (frames != n) {
+            return !stream_mode;
+        }
+        memmove(ch_byte, ch_byte + frames * numChannels, history);
+        left -= n;
     }
     return 0;
 }
@@ -88,13 +347,15 @@ int dsd_unpack_to_float_mix(int numChannels, size_t dataSize,
 void usage()
 {
     fprintf(stderr,
-            "usage: %s [-h] [-p] [-m [-f A][-c A][-s A][-r A]] [dffile] > rawfile\n"
+            "usage: %s [-h] [-p] [-d] [-S] [-m [-f A][-c A][-s A][-r A]] [dffile] > rawfile\n"
             "\nConvert DFF sound file to 32-bit (float) raw.\n"
             "\npositional arguments:\n"
             "  dffile  DSD audio in interchange File Format (use input pipe if absent)\n"
             "\noptional arguments:\n"
             "  -h\tshow this help message and exit\n"
             "  -p\tprint DFF header info and exit\n"
+            "  -d\tdecimate by 8, e.g., output at 352.8 kHz (instead of 2.8224 MHz)\n"
+            "  -S\tstream: read up to the end of the input, whatever the header says\n"
             "  -m\tmixdown 5-channel and 6-channel audio to stereo\n"
             "  -f\tfront channels attenuation A = 0,1,.. (dB) or off, to disable\n"
             "  -c\tcentre channel attenuation A = 0,1,.. (dB) or off, to disable\n"
@@ -130,6 +391,7 @@ int main(int argc, char *argv[])
 {
     int opt_print = 0;
     int opt_mixdown = 0;
+    int opt_decimate = 0;
     FILE *fin = stdin;
     struct weights w = { 1., M_SQRT1_2, M_SQRT1_2, 1. };
     int c;
@@ -139,9 +401,11 @@ int main(int argc, char *argv[])
     prgname = argv[0];
     opterr = 0;
 
-    while ((c = getopt(argc, argv, "pmf:c:r:s:h")) != -1) {
+    while ((c = getopt(argc, argv, "pdSmf:c:r:s:h")) != -1) {
         switch (c) {
             case 'p': opt_print = 1; break;
+            case 'S': stream_mode = 1; break;
+            case 'd': opt_decimate = 1; break;
             case 'm': opt_mixdown = 1; break;
             case 'f': w.front = get_weight(optarg); break;
             case 'c': w.centre = M_SQRT1_2 * get_weight(optarg); break;
@@ -165,6 +429,8 @@ int main(int argc, char *argv[])
         }
     }
 
+    init_luts();
+    init_fir();
     dff_set_input(fin);
     dff_set_input_error_cb(error, NULL);
     ret = dff_parse(&props);
@@ -181,8 +447,15 @@ int main(int argc, char *argv[])
         ret = 0;
     }
     else if (props.numChannels <= NUM_CHANNELS_MAX) {
+        if (stream_mode && props.dataSize == 0) {
+            /* size unknown: up to the end of the input */
+            props.dataSize = SIZE_MAX;
+        }
         if (opt_mixdown) {
-            if (props.numChannels == 5 || props.numChannels == 6) {
+            if ((props.numChannels == 5 || props.numChannels == 6) && opt_decimate) {
+                ret = dsd_decimate_to_float(props.numChannels, props.dataSize, &w, fin, stdout);
+            }
+            else if (props.numChannels == 5 || props.numChannels == 6) {
                 ret = dsd_unpack_to_float_mix(props.numChannels, props.dataSize, &w, fin, stdout);
             }
             else {
@@ -191,6 +464,9 @@ int main(int argc, char *argv[])
                 ret = 1;
             }
         }
+        else if (opt_decimate) {
+            ret = dsd_decimate_to_float(props.numChannels, props.dataSize, NULL, fin, stdout);
+        }
         else {
             ret = dsd_unpack_to_float(props.numChannels, props.dataSize, fin, stdout);
         }        
@@ -201,6 +477,11 @@ int main(int argc, char *argv[])
         ret = 1;
     }
 
+    if (stream_mode) {
+        /* Read what is left: the writer must not get a SIGPIPE */
+        while (fread(tail, 1, sizeof(tail), fin) > 0)
+            ;
+    }
     return ret;
 }
 
@@ -5,6 +5,9 @@
  * into a raw format at 1 float/sample/channel and (multiple of) 2.8224 MHz
  * sampling.
  *
+ * With -p N, it only tests the first N frames (a fast probe, as DoP markers
+ * are present from the very first frame) and reports through its exit status.
+ *
  * DSD over PCM (or DoP) is documented here:
  * https://dsd-guide.com/sites/default/files/white-papers/DoP_openStandard_1v1.pdf
  */
@@ -17,60 +20,105 @@
 
 #define NUM_CHANNELS_MAX (6)
 
+/* Frames read per sf_readf_int call and unpacked per fwrite call */
+#define BLOCK_FRAMES (4096)
+
 static SNDFILE* sf;
 static SF_INFO sf_info;
 static bool test_only;
+static sf_count_t max_frames;
+
+/* DSD byte -> 8 floats (+1/-1), MSB first */
+static float unpack_lut[256][8];
+
+static void init_lut(void)
+{
+    for (unsigned b = 0; b < 256; b++) {
+        for (unsigned j = 0; j < 8; j++) {
+            unpack_lut[b][j] = b & (0x80 >> j) ? 1.f : -1.f;
+        }
+    }
+}
 
 static inline sf_count_t dop_to_pcm(void)
 {
     /* 24-bit samples shall alternate 0x05---- / 0xfa----
      * libsndfile returns 32-bits samples 0x05----00 / 0xfa----00
      */
-    int dop[NUM_CHANNELS_MAX];
-    float out[16 * NUM_CHANNELS_MAX];
+    static int dop[BLOCK_FRAMES * NUM_CHANNELS_MAX];
+    static float out[BLOCK_FRAMES * 16 * NUM_CHANNELS_MAX];
     uint8_t mask[NUM_CHANNELS_MAX] = { 0 };
+    const unsigned channels = sf_info.channels;
 
     sf_count_t i = 0;
-    for ( ; i < sf_info.frames; i++) {
-        if (sf_readf_int(sf, dop, 1) != 1)
+    while (i < max_frames) {
+        sf_count_t n = max_frames - i < BLOCK_FRAMES ? max_frames - i : BLOCK_FRAMES;
+        n = sf_readf_int(sf, dop, n);
+        if (n <= 0)
             break;
 
-        for (int ch = 0; ch < sf_info.channels; ch++) {
-            uint8_t marker = dop[ch] >> 24;
-            if (!mask[ch] && (marker == 0x05 || marker == 0xfa)) {
-                mask[ch] = marker;
-            } else if (marker == (uint8_t)~mask[ch]) {
-                mask[ch] = marker;
-            } else {
-                return i;
+        /* Check the markers up to the first bad frame (if any) */
+        sf_count_t good = 0;
+        for ( ; good < n; good++) {
+            int *frame = &dop[good * channels];
+            unsigned ch = 0;
+            for ( ; ch < channels; ch++) {
+                uint8_t marker = frame[ch] >> 24;
+                if (!mask[ch] && (marker == 0x05 || marker == 0xfa)) {
+                    mask[ch] = marker;
+                } else if (marker == (uint8_t)~mask[ch]) {
+                    mask[ch] = marker;
+                } else {
+                    break;
+                }
             }
-            dop[ch] >>= 8;  /* align the 16 DSD bits with LSB */
+            if (ch < channels)
+                break;
         }
-        if (test_only) continue;
-
-        /* Unpack 16 bits of DSD per channel into 16 channel-interleaved floats
-         */
-        for (unsigned mask = 0x8000, j = 0; mask != 0;
-                mask >>= 1, j += sf_info.channels) {
-            for (unsigned k = 0; k < sf_info.channels; k++) {
-                out[j+k] = dop[k] & mask ? 1.f : -1.f;
+
+        if (!test_only) {
+            /* Unpack 16 bits of DSD per channel (bits 23..8 of the sample)
+             * into 16 channel-interleaved floats */
+            for (sf_count_t f = 0; f < good; f++) {
+                int *frame = &dop[f * channels];
+                float *o = &out[f * 16 * channels];
+                for (unsigned k = 0; k < channels; k++) {
+                    const float *hi = unpack_lut[(uint8_t)(frame[k] >> 16)];
+                    const float *lo = unpack_lut[(uint8_t)(frame[k] >> 8)];
+                    for (unsigned j = 0; j < 8; j++) {
+                        o[j * channels + k] = hi[j];
+                        o[(j + 8) * channels + k] = lo[j];
+                    }
+                }
+            }
+            if (fwrite(out, sizeof(float[16]) * channels, good, stdout) != good) {
+                fprintf(stderr, "Write error... aborting...\n");
+                return i;
             }
         }
-        if (fwrite(out, sizeof(float[16]), sf_info.channels, stdout) != sf_info.channels) {
-            fprintf(stderr, "Write error... aborting...\n");
-            return i;
-        }
+        i += good;
+        if (good != n)
+            break;
     }
     return i;
 }
 
 int main(int argc, char *argv[])
 {
-    if (argc <= 1) {
-        fprintf(stderr, "Usage: dop2dsd DSD_over_PCM.file [> out.dsd]\n");
+    sf_count_t probe_frames = 0;
+    int c;
+
+    while ((c = getopt(argc, argv, "p:")) != -1) {
+        switch (c) {
+            case 'p': probe_frames = atol(optarg); break;
+            default: optind = argc; break;
+        }
+    }
+    if (optind != argc - 1 || probe_frames < 0) {
+        fprintf(stderr, "Usage: dop2raw [-p N] DSD_over_PCM.file [> out.dsd]\n");
         return EXIT_FAILURE;
     }
-    const char *fname = argv[1];
+    const char *fname = argv[optind];
 
     sf = sf_open(fname, SFM_READ, &sf_info);
     if (!sf) {
@@ -91,15 +139,25 @@ int main(int argc, char *argv[])
         return EXIT_FAILURE;
     }
 
-    test_only = isatty(fileno(stdout));
-    if (test_only) {
+    max_frames = sf_info.frames;
+    if (probe_frames) {
+        /* Fast probe: test the first frames only */
+        if (probe_frames < max_frames)
+            max_frames = probe_frames;
+        test_only = true;
+    }
+    else {
+        test_only = isatty(fileno(stdout));
+    }
+    if (test_only && !probe_frames) {
         printf("%s: testing for %d-ch DSD%d\n", fname, sf_info.channels, 64 * dsd_rate);
     }
 
+    init_lut();
     sf_count_t count = dop_to_pcm();
 
-    if (test_only) {
+    if (test_only && !probe_frames) {
         printf("%s:%ld:%s\n", fname, count, count != sf_info.frames ? "ERROR" : "OK");
     }
-    return count != sf_info.frames ? EXIT_FAILURE : EXIT_SUCCESS;
+    return count != max_frames ? EXIT_FAILURE : EXIT_SUCCESS;
 }
@@ -0,0 +1,79 @@
+import os
+import subprocess
+import functools
+from metautils import *
+
+# Flac encoding of the output files, by flac or by sox.  Lossless: the
+# preset only trades encoding time for file size
+# name: compression level, block size (explicit: the block size of a level
+# is not the same in all flac versions)
+ENCODER_PRESETS = {
+    'fast': (1, 1152),
+    'balanced': (5, 4096),
+    'max': (8, 4096),
+}
+DEFAULT_PRESET = 'max'
+
+
+@functools.lru_cache()
+def flac_threads():
+    # flac >= 1.5 encodes with several threads (-j)
+    try:
+        output = subprocess.run(['flac', '--help'], stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT).stdout
+    except OSError:
+        return False
+    return b'--threads' in output
+
+
+class flacencoder:
+
+    def __init__(self, preset=DEFAULT_PRESET, threads=1):
+        self.preset = preset
+        self.level, self.blocksize = ENCODER_PRESETS[preset]
+        self.threads = threads if threads > 1 and flac_threads() else 1
+
+    def flac_cmd(self, outfile, metadata, options=[]):
+        # flac encoding stdin into outfile.  options: e.g., the format of
+        # raw pcm
+        cmd = ['flac', '-%d' % self.level, '-b', str(self.blocksize), '-s']
+        if self.threads > 1:
+            cmd += ['-j', str(self.threads)]
+        return cmd + options + flac_tag_args(metadata) + ['-', '-o', outfile]
+
+    def sox_output(self, outfile, metadata):
+        # sox output file (no block size nor threads there)
+        return ['-C', str(self.level)] + sox_tag_args(metadata) + [outfile]
+
+
+def raw_encoder_cmd(fmt, outfile, metadata, encoder):
+    # flac encoder of raw little-endian pcm read from stdin
+    return encoder.flac_cmd(outfile, metadata, [
+        '--force-raw-format', '--endian=little',
+        '--sign=' + ('unsigned' if fmt['bps'] == 8 else 'signed'),
+        '--channels=' + str(fmt['channels']), '--bps=' + str(fmt['bps']),
+        '--sample-rate=' + str(fmt['srate'])])
+
+
+def raw_decoder_cmd(flacfile, fmt, options=[]):
+    # flac decoder of flacfile into raw pcm on stdout, in the format that
+    # raw_encoder_cmd reads.  options: e.g., --skip and --until
+    return ['flac', '-d', '-c', '-s', '--force-raw-format', '--endian=little',
+            '--sign=' + ('unsigned' if fmt['bps'] == 8 else 'signed')] + \
+        options + [flacfile]
+
+
+def sox_raw_output(bps):
+    # sox output file: raw pcm on stdout, in the format that raw_encoder_cmd
+    # reads (the effects follow)
+    return ['-t', 'raw', '-e', 'unsigned' if bps == 8 else 'signed',
+            '-b', str(bps), '-L', '-']
+
+
+def make_encoder(args, tracks=None):
+    # Encoder of the preset in args.  flac -j gets the cores left by the
+    # folders (-j) and the tracks (-p, up to tracks) encoded in parallel
+    parallel = args.get('jobs', 1) * min(args.get('pipelines', 1),
+                                         tracks or args.get('pipelines', 1))
+    return flacencoder(args.get('preset') or DEFAULT_PRESET,
+                       (os.cpu_count() or 1) // max(1, parallel))
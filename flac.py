@@ -1,7 +1,16 @@
 import os
+import math
 import subprocess
 import logging
+import functools
 from metautils import *
+from folderindex import *
+from pipeline import *
+from manifest import *
+from plan import *
+from stats import *
+from encoder import *
+from replaygain import *
 
 
 def add_dsp_downsampler(dsp, srate):
@@ -15,28 +24,101 @@ def add_dsp_gain(dsp, gain):
     dsp += ['gain', str(gain)]
 
 
-def reencode_with_dsp(flacfile, outfile, dsp):
-    # TODO: Detect DSD over PCM (where DSD is carried as ultrasound) as DSD
-    # will need to be transcoded to PCM first before any DSP is applied (any
-    # DSD over PCM processed as is would no longer play as DSD as detection
-    # needs a bit-perfect stream and would be turned into a fully silent track
-    # once ultrasounds are filtered)
-    cmd = ['sox', '-G', flacfile, '-C', '8', outfile] + dsp
+def mix_weight(attenuation):
+    # attenuation in dB or 'off', as passed to dff2raw -f/-c/-r/-s
+    return 0. if attenuation == 'off' else 10 ** (-attenuation / 20.)
+
+
+def add_dsp_downmix(dsp, channels, args):
+    # Same weights and normalisation as dff2raw -m, as a sox remix matrix
+    # 5 ch: 1-Left, 2-Right, 3-Centre, 4-Rear L, 5-Rear R
+    # 6 ch: 1-Left, 2-Right, 3-Centre, 4-Sub, 5-Rear L, 6-Rear R
+    front = mix_weight(args['front'])
+    ctr = math.sqrt(0.5) * mix_weight(args['ctr'])
+    sub = math.sqrt(0.5) * mix_weight(args['sub']) if channels == 6 else 0.
+    rear = mix_weight(args['rear'])
+    gain = 1. / (front + ctr + sub + rear)
+
+    def mix(*weights):
+        return ','.join(['%dv%.8f' % (ch, w * gain) for ch, w in weights if w])
+
+    dsp += ['remix', '-m',
+            mix((1, front), (3, ctr), (4, sub), (channels - 1, rear)),
+            mix((2, front), (3, ctr), (4, sub), (channels, rear))]
+
+
+# Frames tested by the DoP probe: the markers are there from the first frame
+DOP_PROBE_FRAMES = 4096
+
+
+def is_dop(flacfile, metadata):
+    # Detect DSD over PCM (where DSD is carried as ultrasound): any DSP
+    # applied to it as is would turn it into a fully silent track once
+    # ultrasounds are filtered, so DSD needs to be transcoded to PCM first.
+    # DoP needs 24-bit samples at a multiple of 176.4 kHz, then dop2raw
+    # checks the markers of the first frames only (fast, even on huge files)
+    if metadata['bps'] != 24 or metadata['srate'] % 176400 != 0:
+        return False
+    cmd = ['dop2raw', '-p', str(DOP_PROBE_FRAMES), flacfile]
     logging.debug(cmd)
-    subprocess.call(cmd)
+    return measured_call(cmd, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL) == 0
+
+
+def reencode_dop(flacfile, outfile, channels, srate, dsp, metadata,
+                 encoder, rg=None, fmt=None):
+    # dop2raw <input.flac> | sox -t raw -e float -b 32 -r 2822400 -c 2 -
+    # -b 24 -C 8 <output.flac> rate -v 192000 gain -3
+    # rg: if set, sox writes raw pcm (fmt) to the ReplayGain tap, then to
+    # flac (see replaygain.py)
+    # Returns the pipeline to run (see pipeline.py)
+    cmd = ['dop2raw', flacfile]
+    # 16 DSD bits per DoP sample
+    cmd2 = ['sox', '-t', 'raw', '-e', 'float', '-b', '32', '-r',
+            str(srate * 16), '-c', str(channels), '-']
+    if rg:
+        return [cmd, cmd2 + sox_raw_output(24) + dsp] + \
+            rg.encoder_cmds(fmt, outfile, metadata, encoder)
+    return [cmd, cmd2 + ['-b', '24'] +
+            encoder.sox_output(outfile, metadata) + dsp]
+
+
+def reencode_with_dsp(flacfile, outfile, dsp, metadata, encoder, rg=None,
+                      fmt=None):
+    # rg, fmt: see reencode_dop
+    # Returns the pipeline to run (see pipeline.py)
+    cmd = ['sox', '-G', flacfile]
+    if rg:
+        return [cmd + sox_raw_output(fmt['bps']) + dsp] + \
+            rg.encoder_cmds(fmt, outfile, metadata, encoder)
+    return [cmd + encoder.sox_output(outfile, metadata) + dsp]
 
 
-def reencode_no_dsp(flacfile, outfile):
+def reencode_no_dsp(flacfile, outfile, metadata, encoder, rg=None,
+                    fmt=None):
     # flac -8 -s <input.flac> -o <output.flac>
     # --> may fail with ERROR: input file has an ID3v2 tag
     # Use flac -c -d <input.flac> | flac -8 -s - -o <output.flac>
-    cmd = ['flac', '-c', '-s', '-d', flacfile]
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    logging.debug(cmd)
-    cmd = ['flac', '-8', '-s', '-', '-o', outfile]
-    p2 = subprocess.Popen(cmd, stdin=p.stdout)
-    logging.debug(cmd)
-    p2.communicate()
+    # rg, fmt: see reencode_dop
+    # Returns the pipeline to run (see pipeline.py)
+    if rg:
+        return [raw_decoder_cmd(flacfile, fmt)] + \
+            rg.encoder_cmds(fmt, outfile, metadata, encoder)
+    return [['flac', '-c', '-s', '-d', flacfile],
+            encoder.flac_cmd(outfile, metadata)]
+
+
+def is_conformant(info):
+    # Flac files whose audio frames can be copied as is: no ID3v2 tag in
+    # front of the flac stream and a MD5 signature of the audio.  The audio
+    # itself is not verified (see --reencode)
+    return info['start'] == 0 and any(info['md5'])
+
+
+def copy_no_dsp(flacfile, outfile, metadata):
+    # Returns the step (see pipeline.py) copying the audio, retagged
+    return functools.partial(
+        copy_flac, flacfile, outfile, sorted(metadata.items()))
 
 
 class flactranscoder:
@@ -46,11 +128,11 @@ class flactranscoder:
         # self.directory    -> input directory
         # self.filemeta     -> file:metadata dictionary
 
-    def probe(self, directory):
+    def probe(self, directory, index=None):
         self.directory = directory
-        self.files = sorted(
-            [name for name in os.listdir(directory)
-                if name.lower().endswith('.flac')])
+        if index is None:
+            index = folderindex(directory)
+        self.files = index.names(('.flac',))
         return self.files
 
     def _extract_metadata(self):
@@ -71,45 +153,120 @@ class flactranscoder:
                 metadata['title'] = infer_title(f)
             self.filemeta[f] = metadata
 
-    def _transcode_one(self, f, outdir):
+    def estimate(self):
+        # Work of transcode() (see plan.py), from the flac headers
+        estimates = []
+        for f in self.files:
+            info = read_flac_header(os.path.join(self.directory, f))
+            if info['srate'] > self.args['srate'] or \
+                    self.args['gain'] != 0 or \
+                    (self.args['mix'] and info['channels'] > 2):
+                work = 'rate'
+            elif not self.args['reencode'] and is_conformant(info):
+                work = 'copy'
+            else:
+                work = 'reencode'
+            estimates.append(estimate(
+                'flac', info['samples'] / info['srate'], info['channels'],
+                info['srate'], work))
+        return merge_estimates(estimates)
+
+    def _transcode_one(self, f, outdir, rg=None):
+        # Returns the job (see pipeline.py) creating the track in outdir
+        # rg: albumgain measuring the track (see replaygain.py), if set
         pathname = os.path.join(self.directory, f)
         outfile = get_filename(outdir, self.filemeta[f])
         logging.info('Creating\t' + os.path.basename(outfile))
-        dsp = []
-        if self.filemeta[f]['channels'] > 2 and self.args['mix']:
-            raise NotImplementedError(
-                'Downmix of multi-channel flac is not implemented yet.')
+        mix = []
+        channels = self.filemeta[f]['channels']
+        if channels > 2 and self.args['mix']:
+            if channels not in (5, 6):
+                raise NotImplementedError(
+                    'Downmix of %d-channel flac is not implemented.' %
+                    channels)
+            add_dsp_downmix(mix, channels, self.args)
+        # A single sox pass: mixdown first (less channels to resample)
+        dsp = list(mix)
+        # Format of the output
+        fmt = {'channels': 2 if mix else channels,
+               'srate': self.filemeta[f]['srate'],
+               'bps': self.filemeta[f]['bps']}
         if self.filemeta[f]['srate'] > self.args['srate']:
             add_dsp_downsampler(dsp, self.args['srate'])
+            fmt['srate'] = self.args['srate']
         if self.args['gain'] != 0:
             add_dsp_gain(dsp, self.args['gain'])
-        if dsp:
-            reencode_with_dsp(pathname, outfile, dsp)
-        else:
-            reencode_no_dsp(pathname, outfile)
         metadata = {k: self.filemeta[f][k] for k in
-                    ('album', 'artist', 'date', 'tracknumber', 'title')
+                    ('album', 'artist', 'date', 'tracknumber', 'title',
+                     'comment')
                     if k in self.filemeta[f]}
         logging.debug(metadata)
-        set_meta(metadata, outfile)
+        # Tags are set by the encoder: the output file is written only once
+        if dsp and is_dop(pathname, self.filemeta[f]):
+            # DoP copied as is (no dsp) still plays as DSD
+            logging.info('DSD over PCM\t' + f)
+            dsp = ['rate', '-v', str(self.args['srate']), 'fade', '0.001']
+            dsp += mix
+            if self.args['gain'] != 0:
+                add_dsp_gain(dsp, self.args['gain'])
+            fmt.update(srate=self.args['srate'], bps=24)
+            return [reencode_dop(pathname, outfile, channels,
+                                 self.filemeta[f]['srate'], dsp, metadata,
+                                 self.encoder, rg, fmt)]
+        elif dsp:
+            return [reencode_with_dsp(pathname, outfile, dsp, metadata,
+                                      self.encoder, rg, fmt)]
+        if rg and is_dop(pathname, self.filemeta[f]):
+            # DoP copied as is: no pcm audio to measure
+            rg = None
+        if not self.args['reencode'] and \
+                is_conformant(read_flac_header(pathname)):
+            # No need to decode: only the metadata changes (the tap needs
+            # an analysis of its own)
+            job = [copy_no_dsp(pathname, outfile, metadata)]
+            if rg:
+                job.append(rg.analysis(pathname, outfile))
+            return job
+        else:
+            return [reencode_no_dsp(pathname, outfile, metadata,
+                                    self.encoder, rg, fmt)]
 
-    def transcode(self):
+    def transcode(self, progress=None):
+        if progress is None:
+            progress = albumprogress()
         self._extract_metadata()
+        self.encoder = make_encoder(self.args, len(self.files))
         outdirs = []
         pending = self.files
         while pending:
             next = []
+            jobs = []
             album = self.filemeta[pending[0]]['album']
-            outdir = get_output_dir(
+            outdir = progress.make_output_dir(
                 self.args['rootdir'], self.filemeta[pending[0]])
-            os.mkdir(outdir)
             logging.info('To ' + outdir)
             outdirs.append(outdir)
+            rg = albumgain() if self.args.get('replaygain') else None
+            done = []
             for f in pending:
-                if self.filemeta[f]['album'] == album:
-                    self._transcode_one(f, outdir)
-                else:
+                if self.filemeta[f]['album'] != album:
                     next.append(f)
+                    continue
+                outfile = get_filename(outdir, self.filemeta[f])
+                if progress.done(outfile):
+                    done.append(outfile)
+                else:
+                    jobs.append([outfile] +
+                                self._transcode_one(f, outdir, rg) +
+                                [functools.partial(progress.finished, outfile)])
+            if rg:
+                # ReplayGain of the album: its finished tracks too
+                jobs += rg.missing([outfile for outfile in done if not
+                                    is_dop(outfile, read_flac_header(outfile))])
+            # Tracks of an album are transcoded concurrently
+            run_jobs(jobs, self.args['pipelines'])
+            if rg:
+                rg.tag()
             pending = next
         return outdirs
 
@@ -118,20 +275,21 @@ if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     logging.info('Test 1')
 
-    args = {'srate':48000, 'rootdir':'.', 'mix':False, 'gain':0}
-    t = transcoder(args)
+    args = {'srate':48000, 'rootdir':'.', 'mix':False, 'gain':0, 'pipelines':4,
+            'reencode':False}
+    t = flactranscoder(args)
     f = t.probe('testset/cd')
     assert f, 'check testset/cd folder for cd quality flac files'
     d = t.transcode()
     assert d, 'transcode did not create output folder'
-    logging.warn('DONE - Test 1. Verify ' + str(d) + ' matches testset/cd')
+    logging.warning('DONE - Test 1. Verify ' + str(d) + ' matches testset/cd')
 
     logging.info('Test 2')
     f = t.probe('testset/hr')
     assert f, 'check testset/hr folder for high-res flac files'
     d = t.transcode()
     assert d, 'transcode did not create output folder'
-    logging.warn(
+    logging.warning(
         'DONE - Test 2. Verify ' + str(d) + ' is testset/hr downsampled to 48kHz')
 
     logging.info('Test 3')
@@ -139,17 +297,18 @@ if __name__ == '__main__':
     assert f, 'check testset/mixed for two+ different album files in same folder'
     d = t.transcode()
     assert len(d) >= 2, 'transcode did not create at least 2 output folders'
-    logging.warn(
+    logging.warning(
         'DONE - Test 3. Verify ' + str(d) + ' span all tracks in testset/mixed')
 
     logging.info('Test 4')
 
-    args = {'srate':48000, 'rootdir':'.', 'mix':False, 'gain':-6}
-    t = transcoder(args)
+    args = {'srate':48000, 'rootdir':'.', 'mix':False, 'gain':-6, 'pipelines':4,
+            'reencode':False}
+    t = flactranscoder(args)
     f = t.probe('testset/cd')
     assert f, 'check testset/cd folder for cd quality flac files'
     d = t.transcode()
-    logging.warn(
+    logging.warning(
         'DONE - Test 4. Verify ' + str(d) + ' is testset/cd attenuated by 6 dB')
 
     # TODO: test case of different albums in same folder
@@ -0,0 +1,190 @@
+import os
+import sys
+import fcntl
+import shutil
+import tempfile
+
+# FLAC metadata blocks, see https://xiph.org/flac/format.html
+# Reading/writing them in-process avoids forking metaflac for every file
+
+STREAMINFO = 0
+PADDING = 1
+SEEKTABLE = 3
+VORBIS_COMMENT = 4
+
+# Same as flac's default padding when the metadata no longer fits in place
+DEFAULT_PADDING = 8192
+MAX_BLOCK_LENGTH = (1 << 24) - 1
+
+# ioctl to clone a file (copy-on-write) on btrfs, xfs...
+FICLONE = 0x40049409
+
+
+def skip_id3v2(f):
+    # Returns the size of the ID3v2 tag found at the start of f (if any)
+    header = f.read(10)
+    if len(header) == 10 and header[:3] == b'ID3':
+        # 'ID3' version(2) flags(1) size(4 x 7 bits)
+        size = 0
+        for b in header[6:10]:
+            size = (size << 7) | (b & 0x7f)
+        footer = 10 if header[5] & 0x10 else 0
+        return 10 + size + footer
+    return 0
+
+
+def parse_streaminfo(data, info):
+    # 20 bits sample rate, 3 bits channels-1, 5 bits bps-1, 36 bits samples
+    bits = int.from_bytes(data[10:18], 'big')
+    info['srate'] = bits >> 44
+    info['channels'] = ((bits >> 41) & 0x7) + 1
+    info['bps'] = ((bits >> 36) & 0x1f) + 1
+    info['samples'] = bits & 0xfffffffff
+    info['md5'] = data[18:34]
+
+
+def parse_vorbis_comment(data, info):
+    # Little-endian length-prefixed strings: vendor, then NAME=value entries
+    n = int.from_bytes(data[0:4], 'little')
+    info['vendor'] = data[4:4+n].decode('utf8', 'replace')
+    pos = 8 + n
+    info['tags'] = []
+    for i in range(int.from_bytes(data[4+n:8+n], 'little')):
+        n = int.from_bytes(data[pos:pos+4], 'little')
+        entry = data[pos+4:pos+4+n].decode('utf8', 'replace')
+        name, sep, value = entry.partition('=')
+        info['tags'].append((name, value))
+        pos += 4 + n
+
+
+def vorbis_comment(vendor, tags):
+    entries = [(name + '=' + value).encode('utf8') for name, value in tags]
+    vendor = vendor.encode('utf8')
+    data = [len(vendor).to_bytes(4, 'little'), vendor,
+            len(entries).to_bytes(4, 'little')]
+    for entry in entries:
+        data += [len(entry).to_bytes(4, 'little'), entry]
+    return b''.join(data)
+
+
+def read_flac_header(pathname):
+    # Returns a dictionary with
+    # channels, bps, srate, samples, md5       -> from STREAMINFO
+    # vendor, tags (list of (name, value))     -> from VORBIS_COMMENT
+    # start    -> offset of 'fLaC' (after an optional ID3v2 tag)
+    # blocks   -> list of (type, offset, length) of all metadata blocks
+    # audio    -> offset of the first audio frame
+    info = {'vendor': 'reference libFLAC', 'tags': [], 'blocks': []}
+    with open(pathname, 'rb') as f:
+        info['start'] = skip_id3v2(f)
+        f.seek(info['start'])
+        if f.read(4) != b'fLaC':
+            raise ValueError(pathname + ': not a flac file')
+        last = False
+        while not last:
+            header = f.read(4)
+            if len(header) != 4:
+                raise ValueError(pathname + ': truncated flac metadata')
+            last = header[0] & 0x80
+            type = header[0] & 0x7f
+            length = int.from_bytes(header[1:4], 'big')
+            info['blocks'].append((type, f.tell(), length))
+            if type == STREAMINFO:
+                parse_streaminfo(f.read(length), info)
+            elif type == VORBIS_COMMENT:
+                parse_vorbis_comment(f.read(length), info)
+            else:
+                f.seek(length, os.SEEK_CUR)
+        info['audio'] = f.tell()
+    if 'srate' not in info:
+        raise ValueError(pathname + ': no flac STREAMINFO')
+    return info
+
+
+def metadata_blocks(blocks, padding):
+    # Serialise (type, data) blocks followed by padding bytes (if > 0)
+    if padding:
+        while padding > MAX_BLOCK_LENGTH + 4:
+            blocks.append((PADDING, bytes(MAX_BLOCK_LENGTH)))
+            padding -= MAX_BLOCK_LENGTH + 4
+        blocks.append((PADDING, bytes(padding - 4)))
+    data = []
+    for i, (type, block) in enumerate(blocks):
+        if i == len(blocks) - 1:
+            type |= 0x80
+        data += [bytes([type]), len(block).to_bytes(3, 'big'), block]
+    return b''.join(data)
+
+
+def write_flac_tags(pathname, tags, info=None, keep=None):
+    # Replace all the tags by tags (list of (name, value)).  The metadata
+    # blocks are rewritten in place, using the padding, if they still fit.
+    # Otherwise, the whole file is rewritten with some new padding
+    # keep: if set, types of the other blocks to keep (others are dropped)
+    if info is None:
+        info = read_flac_header(pathname)
+    comment = (VORBIS_COMMENT, vorbis_comment(info['vendor'], tags))
+    blocks = []
+    with open(pathname, 'rb') as f:
+        for type, offset, length in info['blocks']:
+            if type == VORBIS_COMMENT:
+                blocks.append(comment)
+            elif type != PADDING and (keep is None or type in keep):
+                f.seek(offset)
+                blocks.append((type, f.read(length)))
+    if VORBIS_COMMENT not in [type for type, block in blocks]:
+        # right after STREAMINFO, as flac does
+        blocks.insert(1, comment)
+    if len(comment[1]) > MAX_BLOCK_LENGTH:
+        raise ValueError(pathname + ': tags are too large')
+    space = info['audio'] - (info['start'] + 4)
+    padding = space - sum([4 + len(block) for type, block in blocks])
+    if padding == 0 or padding >= 4:
+        with open(pathname, 'r+b') as f:
+            f.seek(info['start'] + 4)
+            f.write(metadata_blocks(blocks, padding))
+        return
+    # Rewrite next to the original, then swap
+    fd, tmpname = tempfile.mkstemp('.flac', dir=os.path.dirname(pathname))
+    try:
+        with os.fdopen(fd, 'wb') as fout, open(pathname, 'rb') as fin:
+            fout.write(fin.read(info['start']))
+            fout.write(b'fLaC')
+            fout.write(metadata_blocks(blocks, DEFAULT_PADDING))
+            fin.seek(info['audio'])
+            shutil.copyfileobj(fin, fout, 1024 * 1024)
+        shutil.copymode(pathname, tmpname)
+        os.replace(tmpname, pathname)
+    except BaseException:
+        os.remove(tmpname)
+        raise
+
+
+def clone_file(pathname, outfile):
+    # Copy-on-write clone if the filesystem supports it, else a plain copy
+    # (done in-kernel by shutil)
+    with open(pathname, 'rb') as fin, open(outfile, 'wb') as fout:
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            return
+        except OSError:
+            pass
+    shutil.copyfile(pathname, outfile)
+
+
+def copy_flac(pathname, outfile, tags):
+    # Create outfile with the same audio frames as pathname, byte for byte
+    # Like a re-encoded file, it only has STREAMINFO, SEEKTABLE and tags
+    clone_file(pathname, outfile)
+    write_flac_tags(outfile, tags, keep=(STREAMINFO, SEEKTABLE))
+
+
+if __name__ == '__main__':
+    for pathname in sys.argv[1:]:
+        info = read_flac_header(pathname)
+        print(pathname)
+        for k in ('channels', 'bps', 'srate', 'samples', 'vendor'):
+            print('  ' + k + ' = ' + str(info[k]))
+        print('  md5 = ' + info['md5'].hex())
+        for name, value in info['tags']:
+            print('  ' + name + '=' + value)
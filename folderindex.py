@@ -0,0 +1,63 @@
+import os
+import hashlib
+
+
+class folderindex:
+    # Listing of a source folder tree, made once with os.scandir and shared
+    # by all the probes (every directory listing is a round trip on NFS)
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.entries = {}   # pathname -> os.DirEntry for all files of the tree
+        self.exts = {}      # lowercase extension -> entries with it
+        self.top = set()    # pathnames of the files directly in directory
+        self._scan(directory, True)
+
+    def _scan(self, directory, top):
+        # Same order as os.walk: the files of a directory, then its subdirs
+        subdirs = []
+        with os.scandir(directory) as it:
+            for entry in sorted(it, key=lambda entry: entry.name):
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                    continue
+                self.entries[entry.path] = entry
+                ext = os.path.splitext(entry.name)[1].lower()
+                self.exts.setdefault(ext, []).append(entry)
+                if top:
+                    self.top.add(entry.path)
+        for subdir in subdirs:
+            self._scan(subdir, False)
+
+    def names(self, exts):
+        # Sorted names of the files directly in the folder with one of exts
+        return sorted([entry.name for ext in exts
+                       for entry in self.exts.get(ext, [])
+                       if entry.path in self.top])
+
+    def find(self, exts):
+        # Pathnames of the files of the whole tree with one of exts
+        return [pathname for pathname, entry in self.entries.items()
+                if os.path.splitext(entry.name)[1].lower() in exts]
+
+    def find_name(self, name):
+        return [pathname for pathname, entry in self.entries.items()
+                if entry.name == name]
+
+    def stat(self, pathname):
+        # DirEntry keeps the result of its first stat() call
+        entry = self.entries.get(pathname)
+        return entry.stat() if entry else os.stat(pathname)
+
+    def fingerprint(self):
+        # Changes whenever a file of the tree is added, removed or modified
+        # (paths are relative: same fingerprint once the folder is renamed)
+        sha1 = hashlib.sha1()
+        for pathname in sorted(self.entries):
+            st = self.stat(pathname)
+            line = '%s\0%d\0%d\n' % (
+                os.path.relpath(pathname, self.directory),
+                st.st_size, st.st_mtime_ns)
+            sha1.update(line.encode('utf8', 'surrogateescape'))
+        return sha1.hexdigest()
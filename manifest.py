@@ -0,0 +1,159 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+from metautils import *
+
+MANIFEST_NAME = '.slickzik.db'
+
+
+class albumprogress:
+    # Output folders and finished tracks of one source folder, as handed to
+    # a transcoder.  An interrupted run is resumed in place: its output
+    # folders are reused (in the same order) and its finished tracks skipped
+
+    def __init__(self, book=None, folder=None, fingerprint=None,
+                 settings=None, row=None):
+        self.book = book
+        self.folder = folder
+        self.fingerprint = fingerprint
+        self.settings = settings
+        self.resumed = row['outdirs'] if row else []
+        self.tracks = set(row['tracks']) if row else set()
+        self.complete = row['complete'] if row else False
+        self.outdirs = []
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def _save(self):
+        if self.book is not None:
+            self.book.put(self.folder, {
+                'fingerprint': self.fingerprint, 'settings': self.settings,
+                'outdirs': self.outdirs, 'tracks': sorted(self.tracks),
+                'complete': self.complete})
+
+    def resumed_dir(self):
+        # Output folder the next make_output_dir call returns, if it is the
+        # one of an interrupted run
+        n = len(self.outdirs)
+        if n < len(self.resumed) and os.path.isdir(self.resumed[n]):
+            return self.resumed[n]
+        return None
+
+    def make_output_dir(self, rootdir, metadata):
+        outdir = self.resumed_dir()
+        if outdir:
+            logging.info('Resuming ' + outdir)
+        else:
+            outdir = make_output_dir(rootdir, metadata)
+        with self.lock:
+            self.outdirs.append(outdir)
+            self._save()
+        return outdir
+
+    def done(self, outfile):
+        # True if outfile was finished by an interrupted run.  Otherwise,
+        # what it left of it (if anything) is removed
+        if outfile in self.tracks and os.path.exists(outfile):
+            logging.info('Finished\t' + os.path.basename(outfile))
+            return True
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        return False
+
+    def finished(self, outfile):
+        # May be called from the threads running the pipeline steps
+        with self.lock:
+            self.tracks.add(outfile)
+            self._save()
+
+    def failed(self, outfile):
+        # The folder will not be complete: the next run retries outfile
+        with self.lock:
+            self.errors += 1
+
+    def finish(self):
+        # All tracks done, unless some failed
+        with self.lock:
+            self.complete = self.errors == 0
+            self._save()
+
+
+class manifest:
+    # Record in rootdir of the source folders processed into it: fingerprint
+    # of their files, settings used, output folders and finished tracks
+
+    def __init__(self, rootdir, enabled=True):
+        self.rootdir = rootdir
+        self.pathname = os.path.join(rootdir, MANIFEST_NAME)
+        self.enabled = enabled
+        # Connect on first use: sqlite connections must not cross a fork()
+        self.db = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.db is None:
+            # concurrent workers may share the file: wait for their locks
+            self.db = sqlite3.connect(self.pathname, timeout=60,
+                                      check_same_thread=False)
+            self.db.execute('''CREATE TABLE IF NOT EXISTS folders (
+                            folder TEXT PRIMARY KEY, data TEXT)''')
+        return self.db
+
+    def get(self, folder):
+        if not self.enabled:
+            return None
+        try:
+            with self.lock:
+                row = self._connect().execute(
+                    'SELECT data FROM folders WHERE folder=?',
+                    (folder,)).fetchone()
+        except sqlite3.Error as e:
+            logging.warning('Manifest disabled: ' + str(e))
+            self.enabled = False
+            return None
+        if not row:
+            return None
+        data = json.loads(row[0])
+        for k in ('outdirs', 'tracks'):
+            data[k] = [os.path.join(self.rootdir, p) for p in data[k]]
+        return data
+
+    def put(self, folder, data):
+        if not self.enabled:
+            return
+        # Output paths are stored relative to rootdir, however it is spelled
+        data = dict(data)
+        for k in ('outdirs', 'tracks'):
+            data[k] = [os.path.relpath(p, self.rootdir) for p in data[k]]
+        try:
+            with self.lock, self._connect() as db:
+                db.execute('INSERT OR REPLACE INTO folders VALUES(?,?)',
+                           (folder, json.dumps(data)))
+        except sqlite3.Error as e:
+            logging.warning('Manifest disabled: ' + str(e))
+            self.enabled = False
+
+    def rename(self, folder, newfolder):
+        # The source folder was renamed (its files are unchanged)
+        if not self.enabled:
+            return
+        try:
+            with self.lock, self._connect() as db:
+                db.execute('UPDATE OR REPLACE folders SET folder=? WHERE folder=?',
+                           (newfolder, folder))
+        except sqlite3.Error as e:
+            logging.warning('Manifest disabled: ' + str(e))
+            self.enabled = False
+
+    def progress(self, folder, fingerprint, settings):
+        # The progress of the previous run is only valid for the same files
+        # processed with the same settings
+        settings = json.loads(json.dumps(settings))
+        row = self.get(folder)
+        if row and (row['fingerprint'] != fingerprint or
+                    row['settings'] != settings):
+            logging.info('Changed since last run: ' + folder)
+            row = None
+        return albumprogress(self, folder, fingerprint, settings, row)
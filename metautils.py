@@ -1,6 +1,6 @@
 import os
-import subprocess
 import re
+from flacmeta import *
 
 
 def dontshout(s):
@@ -62,22 +62,38 @@ def make_pathname(path, name):
     return os.path.join(path, name)
 
 
-def get_output_dir(rootdir, metadata):
+def output_dir_candidates(rootdir, metadata):
+    # Yields the output directory names by order of preference
     if 'date' in metadata:
         outdir = metadata['artist'] + \
             ' - (' + metadata['date'] + ') ' + metadata['album']
     else:
         outdir = metadata['artist'] + ' - ' + metadata['album']
-    outdir = make_pathname(rootdir, outdir)
-    if os.path.exists(outdir):
-        basedir = outdir
-        if 'comment' in metadata:
-            outdir = basedir + ' [' + metadata['comment'] + ']'
-        i = 2
-        while os.path.exists(outdir):
-            outdir = basedir + '.' + str(i)
-            i += 1
-    return outdir
+    basedir = make_pathname(rootdir, outdir)
+    yield basedir
+    if 'comment' in metadata:
+        yield basedir + ' [' + metadata['comment'] + ']'
+    i = 2
+    while True:
+        yield basedir + '.' + str(i)
+        i += 1
+
+
+def get_output_dir(rootdir, metadata):
+    for outdir in output_dir_candidates(rootdir, metadata):
+        if not os.path.exists(outdir):
+            return outdir
+
+
+def make_output_dir(rootdir, metadata):
+    # Create the output directory and return its name.  os.mkdir is atomic,
+    # so concurrent workers racing for the same name each get their own
+    for outdir in output_dir_candidates(rootdir, metadata):
+        try:
+            os.mkdir(outdir)
+        except FileExistsError:
+            continue
+        return outdir
 
 
 def get_filename(outdir, metadata):
@@ -134,17 +150,35 @@ def get_flac_metadata(data):
 
 
 def get_meta(f):
-    cmd = ['metaflac', '--show-channels', '--show-bps', '--show-sample-rate',
-           '--export-tags-to=-', f]
-    metadata = get_flac_metadata(subprocess.check_output(cmd).decode('utf8'))
+    # Same as the output of metaflac --show-channels --show-bps
+    # --show-sample-rate --export-tags-to=-, without forking it
+    info = read_flac_header(f)
+    data = '%d\n%d\n%d\n' % (info['channels'], info['bps'], info['srate'])
+    data += ''.join([name + '=' + value + '\n' for name, value in info['tags']])
+    metadata = get_flac_metadata(data)
     return metadata
 
 
+def flac_tag_args(metadata):
+    # Tags set by the flac encoder itself, same as set_meta
+    args = []
+    for tag, val in sorted(metadata.items()):
+        args += ['-T', tag + '=' + val]
+    return args
+
+
+def sox_tag_args(metadata):
+    # Tags set by sox when writing a flac output file, same as set_meta
+    # (--comment also prevents sox from adding its own comment)
+    args = []
+    for tag, val in sorted(metadata.items()):
+        args += ['--add-comment' if args else '--comment', tag + '=' + val]
+    return args
+
+
 def set_meta(metadata, pathname):
-    cmd = ['--set-tag=' + tag + '=' + val for tag,
-           val in sorted(metadata.items())]
-    cmd = ['metaflac', '--remove-all-tags'] + cmd + [pathname]
-    subprocess.check_call(cmd)
+    # Same as metaflac --remove-all-tags --set-tag=... (sorted by name)
+    write_flac_tags(pathname, sorted(metadata.items()))
 
 
 if __name__ == '__main__':
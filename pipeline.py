@@ -0,0 +1,108 @@
+import os
+import asyncio
+import subprocess
+import logging
+from stats import *
+
+# A pipeline is a list of commands, each one feeding the next one's stdin,
+# like 'cmd1 | cmd2' in a shell.
+# A job is a list of steps run one after the other.  A step is either a
+# pipeline or a python callable (run in a thread not to block the others),
+# or a string: the track the next steps work on (see stats.py).
+
+
+async def start_pipeline(cmds, stdin=None, **kwargs):
+    # Starts the commands of a pipeline and returns their processes.  stdin:
+    # that of the first one (e.g., subprocess.PIPE to write into it)
+    procs = []
+    try:
+        for i, cmd in enumerate(cmds):
+            logging.debug(cmd)
+            r, w = os.pipe() if i < len(cmds) - 1 else (None, None)
+            try:
+                p = await measured_exec(*cmd, stdin=stdin, stdout=w,
+                                        **kwargs)
+            except BaseException:
+                if r is not None:
+                    os.close(r)
+                raise
+            finally:
+                # the children have their own copy of the pipe ends
+                if i > 0:
+                    os.close(stdin)
+                if w is not None:
+                    os.close(w)
+            procs.append(p)
+            stdin = r
+    except BaseException:
+        # Failed to start: do not leave orphans behind
+        await kill_pipeline(procs)
+        raise
+    return procs
+
+
+async def kill_pipeline(procs):
+    for p in procs:
+        if p.returncode is None:
+            p.kill()
+    for p in procs:
+        await asyncio.shield(p.wait())
+
+
+async def run_pipeline(cmds):
+    procs = await start_pipeline(cmds)
+    try:
+        for p in procs:
+            await p.wait()
+    except BaseException:
+        # Cancelled: do not leave orphans behind
+        await kill_pipeline(procs)
+        raise
+    for cmd, p in zip(cmds, procs):
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, cmd)
+
+
+async def run_job(steps):
+    loop = asyncio.get_running_loop()
+    for step in steps:
+        if isinstance(step, str):
+            current_track.set(step)
+        elif callable(step):
+            await loop.run_in_executor(None, step)
+        else:
+            await run_pipeline(step)
+
+
+async def run_jobs_async(jobs, limit):
+    sem = asyncio.Semaphore(limit)
+
+    async def run_one(steps):
+        async with sem:
+            await run_job(steps)
+
+    tasks = [asyncio.ensure_future(run_one(steps)) for steps in jobs]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # First failure (or interruption) cancels all the remaining jobs
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def run_jobs(jobs, limit=1):
+    # Run jobs with at most limit of them at the same time.  Raises the
+    # exception of the first failed job (CalledProcessError for a command)
+    asyncio.run(run_jobs_async(jobs, max(1, limit)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    jobs = [[[['sleep', '1']], [['echo', 'job', str(i)], ['tr', 'a-z', 'A-Z']]]
+            for i in range(4)]
+    run_jobs(jobs, 4)
+    try:
+        run_jobs([[[['sleep', '5']]], [[['false']]]], 2)
+    except subprocess.CalledProcessError as e:
+        logging.info('failed as expected: ' + str(e))
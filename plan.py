@@ -0,0 +1,87 @@
+import sys
+
+# Relative cost of the work per second of audio and channel at 44.1 kHz
+# (rough figures: they are only used to order the folders and to show where
+# the time goes).  A flac -8 encode is the unit
+WORK_COST = {
+    'copy': 0.02,           # flac copied as is, only the tags change
+    'reencode': 1.,         # decode + flac -8
+    'rate': 3.,             # sox dsp (rate, gain, mix) + flac -8
+    'dsd': 0.5,             # dff2raw | sox rate from 2.8224 MHz (64x)
+    'dsd-decimate': 0.15,   # dff2raw -d | sox rate from 352.8 kHz
+}
+
+# Bytes per second and channel of DSD64 (2.8224 MHz, 1 bit)
+DSD_BYTES_PER_SECOND = 2822400 // 8
+
+
+def estimate(kind, seconds, channels, srate, work, tmpspace=0):
+    # Estimate of the work for one source file: work is the worst of the
+    # processing done on it (see WORK_COST)
+    return {'kind': kind, 'seconds': seconds, 'channels': channels,
+            'srate': srate, 'work': [work], 'tmpspace': tmpspace,
+            'cost': seconds * channels * srate / 44100. * WORK_COST[work]}
+
+
+def merge_estimates(estimates):
+    # Estimate of a folder from those of its files
+    total = {'kind': None, 'seconds': 0., 'channels': 0, 'srate': 0,
+             'work': [], 'tmpspace': 0, 'cost': 0.}
+    for e in estimates:
+        total['kind'] = total['kind'] or e['kind']
+        for k in ('seconds', 'tmpspace', 'cost'):
+            total[k] += e[k]
+        for k in ('channels', 'srate'):
+            total[k] = max(total[k], e[k])
+        total['work'] = sorted(set(total['work'] + e['work']))
+    return total
+
+
+def duration(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def size(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024:
+            break
+        n /= 1024.
+    else:
+        unit = 'TB'
+    return '%.1f %s' % (n, unit)
+
+
+def rate(srate):
+    return '%gM' % (srate / 1e6) if srate >= 1000000 else '%gk' % (srate / 1e3)
+
+
+def print_plan(plan):
+    # plan: list of (folder, estimate or None if nothing to do)
+    todo = sorted([(e['cost'], folder, e) for folder, e in plan if e],
+                  reverse=True)
+    total = sum([cost for cost, folder, e in todo]) or 1.
+    print('Plan: %d folders to process (%d with nothing to do), %s of audio, '
+          'up to %s of temp space per folder' % (
+              len(todo), len(plan) - len(todo),
+              duration(sum([e['seconds'] for cost, folder, e in todo])),
+              size(max([e['tmpspace'] for cost, folder, e in todo] or [0]))))
+    print('%6s  %8s  %2s  %7s  %-22s  %s' % (
+        'cost', 'duration', 'ch', 'rate', 'work', 'folder'))
+    for cost, folder, e in todo:
+        print('%5.1f%%  %8s  %2d  %7s  %-22s  %s' % (
+            100. * cost / total, duration(e['seconds']), e['channels'],
+            rate(e['srate']), e['kind'] + ': ' + ','.join(e['work']),
+            folder))
+    for folder, e in plan:
+        if not e:
+            print('%6s  %8s  %2s  %7s  %-22s  %s' % (
+                '-', '-', '-', '-', 'nothing to do', folder))
+    sys.stdout.flush()
+
+
+def longest_first(plan):
+    # Folders by decreasing cost, those with nothing to do last
+    return [folder for cost, folder in sorted(
+        [(e['cost'] if e else -1., folder) for folder, e in plan],
+        key=lambda x: -x[0])]
@@ -0,0 +1,134 @@
+import os
+import math
+import logging
+import tempfile
+from flacmeta import *
+from encoder import *
+
+# ReplayGain 2.0: loudness as in ITU-R BS.1770 (EBU R128), measured by
+# rgtap (see rgtap/rgtap.c) while the audio streams to the encoder
+REPLAYGAIN_REFERENCE = -18.       # LUFS
+ABSOLUTE_GATE = -70.              # LUFS
+RELATIVE_GATE = -10.              # LU below the loudness of the blocks above
+                                  # the absolute gate
+
+
+def block_loudness(z):
+    # Loudness (LUFS) of the weighted mean square z of a block
+    return -0.691 + 10 * math.log10(z) if z > 0 else -math.inf
+
+
+def integrated_loudness(blocks):
+    # Gated loudness (LUFS) of the blocks, None if all of them are silent
+    blocks = [z for z in blocks if block_loudness(z) > ABSOLUTE_GATE]
+    if not blocks:
+        return None
+    gate = block_loudness(sum(blocks) / len(blocks)) + RELATIVE_GATE
+    blocks = [z for z in blocks if block_loudness(z) > gate]
+    return block_loudness(sum(blocks) / len(blocks))
+
+
+def read_rgtap_report(pathname):
+    # Returns peak, clipped samples and blocks written by rgtap
+    with open(pathname) as f:
+        peak = float(f.readline().split()[1])
+        clipped = int(f.readline().split()[1])
+        n = int(f.readline().split()[1])
+        blocks = [float(f.readline()) for i in range(n)]
+    return peak, clipped, blocks
+
+
+def replaygain_tags(kind, loudness, peak):
+    # kind: 'TRACK' or 'ALBUM'
+    return [('REPLAYGAIN_%s_GAIN' % kind,
+             '%+.2f dB' % (REPLAYGAIN_REFERENCE - loudness)),
+            ('REPLAYGAIN_%s_PEAK' % kind, '%.6f' % peak)]
+
+
+def dbfs(peak):
+    return 20 * math.log10(peak) if peak > 0 else -math.inf
+
+
+class albumgain:
+    # Track and album gain of the tracks of one output folder.  Each track
+    # pipeline gets a tap between its decoder (or sox) and its encoder, or,
+    # if its audio is not decoded (copied as is or finished by an
+    # interrupted run), an analysis pipeline of its own.  Once all the tracks
+    # are done, tag() adds the REPLAYGAIN_* tags to them.  Only the metadata
+    # blocks are rewritten: the encoders leave padding for them
+
+    def __init__(self):
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='slickzik-rg-')
+        self.reports = {}           # output file -> rgtap report
+
+    def tap(self, outfile, fmt, copy=True):
+        # rgtap command measuring the raw pcm (fmt: channels, srate, bps) of
+        # outfile.  copy: pass the pcm through (to the encoder)
+        report = os.path.join(self.tmpdir.name, '%d.txt' % len(self.reports))
+        self.reports[outfile] = report
+        cmd = ['rgtap', '-c', str(fmt['channels']), '-r', str(fmt['srate']),
+               '-b', str(fmt['bps']), '-o', report]
+        return cmd if copy else cmd + ['-n']
+
+    def encoder_cmds(self, fmt, outfile, metadata, encoder):
+        # Tap and flac encoder of raw pcm (fmt) from stdin, the end of a
+        # pipeline whose decoder writes raw pcm (see sox_raw_output)
+        return [self.tap(outfile, fmt),
+                raw_encoder_cmd(fmt, outfile, metadata, encoder)]
+
+    def analysis(self, flacfile, outfile):
+        # Pipeline measuring outfile, whose audio is the one of flacfile
+        info = read_flac_header(flacfile)
+        return [raw_decoder_cmd(flacfile, info),
+                self.tap(outfile, info, copy=False)]
+
+    def missing(self, outfiles):
+        # Jobs measuring the outfiles that are not measured yet (finished by
+        # an interrupted run)
+        return [[outfile, self.analysis(outfile, outfile)]
+                for outfile in outfiles if outfile not in self.reports and
+                os.path.exists(outfile)]
+
+    def tag(self):
+        # Adds the REPLAYGAIN_* tags to the measured tracks.  The album is
+        # skipped if one of them failed: the next run resumes it
+        tracks = []
+        for outfile, report in sorted(self.reports.items()):
+            if not os.path.exists(outfile) or not os.path.exists(report):
+                logging.warning('No ReplayGain tags: ' +
+                                os.path.basename(outfile) + ' failed')
+                return
+            tracks.append((outfile, read_rgtap_report(report)))
+        self.tmpdir.cleanup()
+        self.reports = {}
+        if not tracks:
+            return
+        blocks = sum([measures[2] for outfile, measures in tracks], [])
+        album = integrated_loudness(blocks)
+        peak = max([measures[0] for outfile, measures in tracks])
+        clipped = sum([measures[1] for outfile, measures in tracks])
+        for outfile, (track_peak, track_clipped, track_blocks) in tracks:
+            loudness = integrated_loudness(track_blocks)
+            info = read_flac_header(outfile)
+            tags = [(name, value) for name, value in info['tags']
+                    if not name.upper().startswith('REPLAYGAIN_')]
+            if loudness is not None:
+                tags += replaygain_tags('TRACK', loudness, track_peak)
+            if album is not None:
+                tags += replaygain_tags('ALBUM', album, peak)
+            write_flac_tags(outfile, tags, info)
+            if track_clipped:
+                logging.debug('%s: %d samples at full scale' %
+                              (os.path.basename(outfile), track_clipped))
+        if album is None:
+            logging.info('ReplayGain\tsilent album, no album gain')
+        else:
+            logging.info('ReplayGain\talbum %.1f LUFS, gain %+.2f dB, '
+                         'peak %.2f dBFS' % (album,
+                                             REPLAYGAIN_REFERENCE - album,
+                                             dbfs(peak)))
+        if clipped:
+            # e.g., sox clips what -g pushes over full scale: the peak tells
+            # how much headroom is left otherwise
+            logging.warning('Clipping\t%d samples at full scale, lower -g' %
+                            clipped)
@@ -0,0 +1,272 @@
+/* vim: set ts=4 sw=4 et :
+ *
+ * This program measures the loudness and the peak of raw pcm on its way from
+ * a decoder to an encoder: it copies stdin to stdout as is (unless -n) and
+ * writes its measures to a report file once the input ends.
+ *
+ * Loudness as in ITU-R BS.1770-4 (EBU R128, ReplayGain 2.0): K-weighting
+ * filter, then the mean square of 400 ms blocks every 100 ms, summed over
+ * the channels with their weights.  The gating of the blocks is left to the
+ * caller, who may pool the blocks of all the tracks of an album.
+ *
+ * Report (text):
+ *   peak <sample peak, 1.0 = full scale>
+ *   clipped <number of samples at full scale>
+ *   blocks <n>
+ *   <n lines: weighted mean square of each block>
+ *
+ * Input: interleaved little-endian samples, signed (16, 24 or 32 bits) or
+ * unsigned (8 bits), as written by flac -d --force-raw-format and sox -t raw.
+ */
+
+#include <errno.h>
+#include <math.h>
+#include <stdbool.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <unistd.h>
+
+#define NUM_CHANNELS_MAX (8)
+
+/* Bytes read (and written) per read call */
+#define BUFFER_SIZE (65536)
+
+/* K-weighting: pre-filter (high shelf) then RLB filter (high pass) */
+struct biquad {
+    double b0, b1, b2, a1, a2;
+};
+
+static struct biquad shelf, highpass;
+static double state[NUM_CHANNELS_MAX][4];
+static double weight[NUM_CHANNELS_MAX];
+
+static unsigned channels, srate, bps;
+static bool copy = true;
+
+/* Sum of squares of the current 100 ms segment, last 4 segments */
+static double segment, segments[4];
+static unsigned long segment_frames, num_segments;
+
+static double *blocks;
+static size_t num_blocks, max_blocks;
+
+static double peak;
+static unsigned long clipped;
+
+/* Coefficients of BS.1770 at any sample rate, from the analog prototypes
+ * (same as libebur128) */
+static void init_filters(void)
+{
+    double f0 = 1681.974450955533;
+    double G = 3.999843853973347;
+    double Q = 0.7071752369554196;
+    double K = tan(M_PI * f0 / srate);
+    double Vh = pow(10.0, G / 20.0);
+    double Vb = pow(Vh, 0.4996667741545416);
+    double a0 = 1.0 + K / Q + K * K;
+
+    shelf.b0 = (Vh + Vb * K / Q + K * K) / a0;
+    shelf.b1 = 2.0 * (K * K - Vh) / a0;
+    shelf.b2 = (Vh - Vb * K / Q + K * K) / a0;
+    shelf.a1 = 2.0 * (K * K - 1.0) / a0;
+    shelf.a2 = (1.0 - K / Q + K * K) / a0;
+
+    f0 = 38.13547087602444;
+    Q = 0.5003270373238773;
+    K = tan(M_PI * f0 / srate);
+    a0 = 1.0 + K / Q + K * K;
+    highpass.b0 = 1.0;
+    highpass.b1 = -2.0;
+    highpass.b2 = 1.0;
+    highpass.a1 = 2.0 * (K * K - 1.0) / a0;
+    highpass.a2 = (1.0 - K / Q + K * K) / a0;
+}
+
+/* Channel weights: 1.0 for front channels, 1.41 (+1.5 dB) for surround
+ * channels, 0 for the LFE.  flac channel orders:
+ * 4 ch: L R BL BR, 5 ch: L R C BL BR, 6 ch: L R C LFE BL BR */
+static void init_weights(void)
+{
+    for (unsigned ch = 0; ch < channels; ch++)
+        weight[ch] = 1.0;
+    if (channels == 4) {
+        weight[2] = weight[3] = 1.41;
+    }
+    else if (channels == 5) {
+        weight[3] = weight[4] = 1.41;
+    }
+    else if (channels >= 6) {
+        weight[3] = 0.0;
+        weight[4] = weight[5] = 1.41;
+    }
+}
+
+static inline double filter(const struct biquad *f, double *z, double x)
+{
+    /* Direct form II transposed */
+    double y = f->b0 * x + z[0];
+    z[0] = f->b1 * x - f->a1 * y + z[1];
+    z[1] = f->b2 * x - f->a2 * y;
+    return y;
+}
+
+static void add_block(double z)
+{
+    if (num_blocks == max_blocks) {
+        max_blocks = max_blocks ? 2 * max_blocks : 4096;
+        blocks = realloc(blocks, max_blocks * sizeof(*blocks));
+        if (!blocks) {
+            fprintf(stderr, "rgtap: out of memory\n");
+            exit(EXIT_FAILURE);
+        }
+    }
+    blocks[num_blocks++] = z;
+}
+
+static void end_segment(void)
+{
+    /* 400 ms block = the last 4 segments of 100 ms (75% overlap) */
+    segments[num_segments++ % 4] = segment;
+    segment = 0.0;
+    segment_frames = 0;
+    if (num_segments >= 4) {
+        double sum = segments[0] + segments[1] + segments[2] + segments[3];
+        add_block(sum / (4 * (srate / 10)));
+    }
+}
+
+static void measure(const uint8_t *data, size_t frames)
+{
+    const unsigned bytes = bps / 8;
+    const double scale = 1.0 / (double)(1u << (bps - 1));
+    const int32_t max = (int32_t)((1u << (bps - 1)) - 1);
+    const int32_t min = -max - 1;
+
+    for (size_t i = 0; i < frames; i++) {
+        double sum = 0.0;
+        for (unsigned ch = 0; ch < channels; ch++) {
+            int32_t s;
+            if (bytes == 1) {
+                s = (int32_t)data[0] - 128;
+            }
+            else {
+                uint32_t u = 0;
+                for (unsigned b = 0; b < bytes; b++)
+                    u |= (uint32_t)data[b] << (8 * b);
+                /* sign extension */
+                s = (int32_t)(u << (32 - bps)) >> (32 - bps);
+            }
+            data += bytes;
+            if (s >= max || s <= min)
+                clipped++;
+            double x = s * scale;
+            if (fabs(x) > peak)
+                peak = fabs(x);
+            double y = filter(&shelf, state[ch], x);
+            y = filter(&highpass, state[ch] + 2, y);
+            sum += weight[ch] * y * y;
+        }
+        segment += sum;
+        if (++segment_frames == srate / 10)
+            end_segment();
+    }
+}
+
+static bool write_all(const uint8_t *data, size_t n)
+{
+    while (n) {
+        ssize_t w = write(STDOUT_FILENO, data, n);
+        if (w < 0) {
+            if (errno == EINTR)
+                continue;
+            return false;
+        }
+        data += w;
+        n -= w;
+    }
+    return true;
+}
+
+static int write_report(const char *pathname)
+{
+    FILE *f = fopen(pathname, "w");
+    if (!f) {
+        perror(pathname);
+        return EXIT_FAILURE;
+    }
+    fprintf(f, "peak %.9f\nclipped %lu\nblocks %zu\n", peak, clipped,
+            num_blocks);
+    for (size_t i = 0; i < num_blocks; i++)
+        fprintf(f, "%.9e\n", blocks[i]);
+    if (fclose(f)) {
+        perror(pathname);
+        return EXIT_FAILURE;
+    }
+    return EXIT_SUCCESS;
+}
+
+static void usage(void)
+{
+    fprintf(stderr,
+            "usage: rgtap [-n] -c channels -r rate -b bits -o report < raw [> raw]\n"
+            "\nMeasure loudness and peak of raw pcm (see rgtap.c) and copy it.\n"
+            "\noptional arguments:\n"
+            "  -n\tdo not copy the input to the output\n"
+            "  -c\tnumber of channels (1 to %d)\n"
+            "  -r\tsample rate (Hz)\n"
+            "  -b\tbits per sample: 8 (unsigned), 16, 24 or 32 (signed)\n"
+            "  -o\treport file\n", NUM_CHANNELS_MAX);
+}
+
+int main(int argc, char *argv[])
+{
+    const char *report = NULL;
+    int c;
+
+    while ((c = getopt(argc, argv, "nc:r:b:o:h")) != -1) {
+        switch (c) {
+            case 'n': copy = false; break;
+            case 'c': channels = atoi(optarg); break;
+            case 'r': srate = atoi(optarg); break;
+            case 'b': bps = atoi(optarg); break;
+            case 'o': report = optarg; break;
+            default: usage(); return EXIT_FAILURE;
+        }
+    }
+    if (optind != argc || !report || channels < 1 ||
+            channels > NUM_CHANNELS_MAX || srate < 10 ||
+            (bps != 8 && bps != 16 && bps != 24 && bps != 32)) {
+        usage();
+        return EXIT_FAILURE;
+    }
+    init_filters();
+    init_weights();
+
+    static uint8_t buffer[BUFFER_SIZE];
+    const size_t framesize = channels * bps / 8;
+    size_t pending = 0;     /* bytes of an incomplete frame */
+    for (;;) {
+        ssize_t n = read(STDIN_FILENO, buffer + pending,
+                         sizeof(buffer) - pending);
+        if (n < 0) {
+            if (errno == EINTR)
+                continue;
+            perror("rgtap");
+            return EXIT_FAILURE;
+        }
+        if (n == 0)
+            break;
+        if (copy && !write_all(buffer + pending, n)) {
+            perror("rgtap");
+            return EXIT_FAILURE;
+        }
+        n += pending;
+        size_t frames = n / framesize;
+        measure(buffer, frames);
+        pending = n - frames * framesize;
+        for (size_t i = 0; i < pending; i++)
+            buffer[i] = buffer[frames * framesize + i];
+    }
+    return write_report(report);
+}
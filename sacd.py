@@ -3,101 +3,197 @@ import subprocess
 import logging
 import re
 import tempfile
+import shutil
+import signal
+import asyncio
+import functools
 from metautils import *
+from folderindex import *
+from cache import *
+from pipeline import *
+from manifest import *
+from plan import *
+from stats import *
+from encoder import *
+from replaygain import *
+
+def parse_sacd_info(log):
+    # Keep what we need from 'sacd_extract -P' output (JSON serialisable)
+    info = {}
+    match = re.findall(r'Title:\s*(.*)', log, re.MULTILINE)
+    info['title'] = match[0] if match else None
+    match = re.findall(r'Artist:\s*(.*)', log, re.MULTILINE)
+    info['artist'] = match[0] if match else None
+    info['dates'] = sorted(re.findall(r'19\d{2}|20\d{2}', log, re.MULTILINE))
+    # The number of tracks and their names may differ btw areas
+    info['areas'] = [
+        {'channels': int(area[0]),
+         'titles': re.findall(r'Title\[\d+\]:\s*(.*)', area, re.MULTILINE)}
+        for area in re.split(r'Speaker config: ', log, 0, re.MULTILINE)[1:]]
+    return info
+
+
+async def progress_lines(stream, size=65536):
+    # Lines of stream, split on '\r' as well: sacd_extract rewrites its
+    # progress with '\r' only, and StreamReader lines are limited in length
+    pending = b''
+    while True:
+        data = await stream.read(size)
+        if not data:
+            break
+        lines = re.split(rb'[\r\n]', pending + data)
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+def dff_name(idx, title):
+    # Name of the dff file of track idx written by sacd_extract -p, as far
+    # as we know (see _start_streams)
+    return re.sub(r'[\\/:*?"<>|]', '_', '%02d - %s' % (idx, title)) + '.dff'
+
 
 class sacdtranscoder:
 
     def __init__(self, args={}):
         self.args = args
+        self.cache = filecache('sacd', args['cache'])
         # self.directory    -> input directory
+        # self.info         -> isofile:parsed sacd info dictionary
         # self.metadata     -> Common metadata (no track titles and numbers)
         # self.titles       -> Track titles (implicit numbering)
+        # self.raw_titles   -> Same, as in the sacd (dff file names)
         # self.channels     -> Number of channels of current iso>area (2,5,6)
+        # self.rg           -> albumgain of current iso (--replaygain)
 
     def _mch(self):
         logging.debug(self.args)
         return self.args['mix'] or self.args['mch']
 
-    def probe(self, directory):
+    def probe(self, directory, index=None):
         self.directory = directory
-        files = sorted(
-            [name for name in os.listdir(directory)
-                if name.lower().endswith('.iso')])
+        if index is None:
+            index = folderindex(directory)
+        self.index = index
+        files = index.names(('.iso',))
         self.files = []
+        self.info = {}
         for f in files:
             isofile = os.path.join(self.directory, f)
             logging.debug(isofile)
-            output = self._sacd_extract_info(isofile)
-            match = re.findall(r'Speaker config: (\d) Channel', output, re.MULTILINE)
+            self.info[isofile] = self._sacd_info(isofile)
+            match = [area['channels'] for area in self.info[isofile]['areas']]
             if self._mch():
                 # Require a multichannel track
-                if not ('5' in match or '6' in match):
+                if not (5 in match or 6 in match):
                     logging.info(isofile + ' has no multichannel track')
                     continue
-            elif not '2' in match:
+            elif not 2 in match:
                 # Not a SACD iso: SACD must have a stereo track
                 logging.info(isofile + ' is not a SACD')
                 continue
             self.files.append(isofile)
+        self.cache.flush()
         return self.files
 
     def _extract_metadata(self, isofile):
-        log = self._sacd_extract_info(isofile)
+        info = self.info[isofile]
         self.metadata = {}
         album, artist, date = infer_from_dir(self.directory)
-        match = re.findall(r'Title:\s*(.*)', log, re.MULTILINE)
-        if match:
-            self.metadata['album'] = dontshout(match[0])
+        if info['title']:
+            self.metadata['album'] = dontshout(info['title'])
         else:
             self.metadata['album'] = album
-        match = re.findall(r'Artist:\s*(.*)', log, re.MULTILINE)
-        if match:
-            self.metadata['artist'] = dontshout(match[0])
+        if info['artist']:
+            self.metadata['artist'] = dontshout(info['artist'])
         else:
             self.metadata['artist'] = artist
-        match = re.findall(r'19\d{2}|20\d{2}', log, re.MULTILINE)
-        if match:
-            match.sort()
-            logging.debug('possible dates ' + str(match))
-            self.metadata['date'] = match[0]
+        if info['dates']:
+            logging.debug('possible dates ' + str(info['dates']))
+            self.metadata['date'] = info['dates'][0]
         if date:
             if ('date' not in self.metadata) or (date < self.metadata['date']):
                 self.metadata['date'] = date
             logging.debug('date ' + self.metadata['date'])
         # Get metadata corresponding to the requested area (stereo, mch)
-        # as the number of tracks and their names may differ btw areas
-        area = re.split(r'Speaker config: ', log, 0, re.MULTILINE)
-        area = area[-1] if self._mch() else area[1]
+        area = info['areas'][-1] if self._mch() else info['areas'][0]
         logging.debug(area)
-        self.channels = int(area[0])
-        self.titles = re.findall(r'Title\[\d+\]:\s*(.*)', area, re.MULTILINE)
+        self.channels = area['channels']
+        self.titles = area['titles']
+        self.raw_titles = area['titles']
         if self.titles:
             self.titles = dontshout('\n'.join(self.titles)).split('\n')
         logging.debug(self.titles)
 
+    def _sacd_info(self, isofile):
+        # Reading the TOC is slow (spinning disks): use the cache if we can
+        st = self.index.stat(isofile)
+        info = self.cache.get(isofile, st)
+        if info is None:
+            info = parse_sacd_info(self._sacd_extract_info(isofile))
+            self.cache.put(isofile, info, st)
+        return info
+
     def _sacd_extract_info(self, isofile):
         # Extracts sacd area info
         cmd = ['sacd_extract', '-i', os.path.realpath(isofile), '-P']
         logging.debug(cmd)
-        output = subprocess.check_output(cmd).decode()
+        output = measured_check_output(cmd).decode()
         logging.debug(output)
         return output
 
-    def _transcode_one(self, idx, dff, outdir):
-        self.metadata['tracknumber'] = '%02d' % idx
+    def estimate(self):
+        # Work of transcode() (see plan.py).  The TOC does not give the
+        # duration: guess it from the iso size (all areas, no DST compression)
+        estimates = []
+        for isofile in self.files:
+            info = self.info[isofile]
+            area = info['areas'][-1] if self._mch() else info['areas'][0]
+            seconds = self.index.stat(isofile).st_size / DSD_BYTES_PER_SECOND \
+                / sum([a['channels'] for a in info['areas']])
+            # Extracted dff files of the area, at most tmpspace of them
+            tmpspace = seconds * DSD_BYTES_PER_SECOND * area['channels']
+            if self.args['tmpspace']:
+                tmpspace = min(tmpspace, self.args['tmpspace'] * 1024 * 1024)
+            estimates.append(estimate(
+                'sacd', seconds, area['channels'], 2822400,
+                'dsd-decimate' if self.args['decimate'] else 'dsd',
+                int(tmpspace)))
+        return merge_estimates(estimates)
+
+    def _track_metadata(self, idx):
+        metadata = dict(self.metadata)
+        metadata['tracknumber'] = '%02d' % idx
         # May fail if SACD does not embedded title
         try:
-            self.metadata['title'] = self.titles[idx - 1]
+            metadata['title'] = self.titles[idx - 1]
         except:
-            self.metadata['title'] = 'Unknown Title'
+            metadata['title'] = 'Unknown Title'
         else:
             # Remove all spurious spaces
-            self.metadata['title'] = ' '.join(self.metadata['title'].split())
-        outfile = get_filename(outdir, self.metadata)
+            metadata['title'] = ' '.join(metadata['title'].split())
+        return metadata
+
+    def _transcode_one(self, idx, dff, outdir, stream=False):
+        # Returns the job (see pipeline.py) converting dff into outdir
+        # stream: dff is a FIFO sacd_extract writes into (see _stream)
+        metadata = self._track_metadata(idx)
+        outfile = get_filename(outdir, metadata)
         logging.info('Creating\t' + os.path.basename(outfile))
         # dff2raw <file.dff> | sox -t raw -e float -b 32 -r 2822400 -c 2 -
-        # -b 24 <file.flac> rate -v 48000 gain 6 stats
+        # -b 24 -C 8 <file.flac> rate -v 48000 gain 6
+        # With --replaygain, sox writes raw pcm to rgtap (loudness, peak and
+        # clipping), then to flac
         cmd = ['dff2raw', dff]
+        if stream:
+            cmd += ['-S']
+        rate = 2822400
+        if self.args['decimate']:
+            # dff2raw does the first decimation stage (by 8), sox the rest
+            cmd += ['-d']
+            rate //= 8
         if self.args['mix'] and self.channels >= 5:
             channels = 2
             cmd += ['-m'] + \
@@ -105,74 +201,274 @@ class sacdtranscoder:
                     for k in ('front', 'ctr', 'rear', 'sub')]
         else:
             channels = self.channels
-        logging.debug(cmd)
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        cmd = ['sox', '-t', 'raw', '-e', 'float', '-b', '32', '-r', '2822400',
-               '-c', str(channels), '-', '-b', '24', outfile,
-               'rate', '-v', str(self.args['srate']),
-               'fade', '0.001']
+        cmd2 = ['sox', '-t', 'raw', '-e', 'float', '-b', '32', '-r', str(rate),
+                '-c', str(channels), '-']
+        if self.rg:
+            cmd2 += sox_raw_output(24)
+        else:
+            # Tags are set by sox: the output file is written only once
+            cmd2 += ['-b', '24'] + self.encoder.sox_output(outfile, metadata)
+        cmd2 += ['rate', '-v', str(self.args['srate']), 'fade', '0.001']
         if self.args['gain'] != 0:
-            cmd += ['gain', str(self.args['gain'])]
+            cmd2 += ['gain', str(self.args['gain'])]
         # Don't generate flac with odd-channel count (ALSA no more supports)
         if self.channels == 5:
             # flac channel order: 1=L, 2=R, 3=C, 4=null LFE, 5/6 = rear
-            cmd += ['remix', '1', '2', '3', '0', '4', '5']
-        logging.debug(cmd)
-        p2 = subprocess.Popen(cmd, stdin=p.stdout)
-        p2.communicate()
-        logging.debug(self.metadata)
-        set_meta(self.metadata, outfile)
-        # remove intermediary file created by sacd_extract
-        os.remove(dff)
-
-    def transcode(self):
+            cmd2 += ['remix', '1', '2', '3', '0', '4', '5']
+            channels = 6
+        logging.debug(metadata)
+        if self.rg:
+            fmt = {'channels': channels, 'srate': self.args['srate'],
+                   'bps': 24}
+            return [[cmd, cmd2] +
+                    self.rg.encoder_cmds(fmt, outfile, metadata, self.encoder)]
+        return [[cmd, cmd2]]
+
+    def _tmpspace(self, tmpdir):
+        # Max bytes of extracted dff files waiting for conversion
+        if self.args['tmpspace']:
+            return self.args['tmpspace'] * 1024 * 1024
+        return shutil.disk_usage(tmpdir).free // 2
+
+    def _may_extract(self):
+        return (self.pending < self.args['pipelines'] and
+                self.pending_size <= self.tmpspace)
+
+    async def _enqueue(self, p, idx, dff, queue, cond):
+        size = os.path.getsize(dff)
+        outdir = self.outdir[-1]
+        outfile = get_filename(outdir, self._track_metadata(idx))
+        job = [outfile] + self._transcode_one(idx, dff, outdir) + \
+            [functools.partial(self.progress.finished, outfile)]
+        async with cond:
+            self.pending += 1
+            self.pending_size += size
+            queue.put_nowait((job, dff, size))
+            if p is not None and not self._may_extract():
+                # Back-pressure: suspend sacd_extract until the converters
+                # have caught up, so that it cannot fill the temp space
+                logging.debug('Pausing extraction')
+                p.send_signal(signal.SIGSTOP)
+                try:
+                    await cond.wait_for(self._may_extract)
+                finally:
+                    p.send_signal(signal.SIGCONT)
+
+    async def _convert(self, queue, cond):
+        # Consumer: dff2raw | sox of extracted dff files
+        while True:
+            job, dff, size = await queue.get()
+            try:
+                await run_job(job)
+            finally:
+                # remove intermediary file created by sacd_extract
+                os.remove(dff)
+                async with cond:
+                    self.pending -= 1
+                    self.pending_size -= size
+                    cond.notify_all()
+                queue.task_done()
+
+    def _start_streams(self, dff, idx, outdir):
+        # The tracks after the first one are written into FIFOs, for their
+        # converters to read as they are extracted (no dff file on disk),
+        # if the first dff file is named as we expect the others to be
+        dirname, name = os.path.split(dff)
+        if name != dff_name(idx, self._raw_title(idx)):
+            logging.debug('Not streaming: unexpected dff name ' + name)
+            return
+        slots = asyncio.Semaphore(2)
+        for next_idx in self.tracks:
+            if next_idx <= idx:
+                continue
+            fifo = os.path.join(dirname, dff_name(next_idx,
+                                                  self._raw_title(next_idx)))
+            try:
+                os.mkfifo(fifo)
+            except FileExistsError:
+                # sacd_extract got there first: a dff file
+                continue
+            self.fifos[next_idx] = fifo
+            self.streams[next_idx] = asyncio.ensure_future(
+                self._stream(next_idx, fifo, outdir, slots))
+
+    def _raw_title(self, idx):
+        try:
+            return self.raw_titles[idx - 1]
+        except IndexError:
+            return ''
+
+    async def _stream(self, idx, fifo, outdir, slots):
+        # Converts the track sacd_extract writes into fifo.  The converter of
+        # the next track starts meanwhile (dff2raw waits for sacd_extract to
+        # open its FIFO): sacd_extract never waits for a reader
+        outfile = get_filename(outdir, self._track_metadata(idx))
+        try:
+            async with slots:
+                job = [outfile] + \
+                    self._transcode_one(idx, fifo, outdir, stream=True) + \
+                    [functools.partial(self.progress.finished, outfile)]
+                await run_job(job)
+        except asyncio.CancelledError:
+            # Not written into fifo after all (or interrupted)
+            if os.path.exists(outfile):
+                os.remove(outfile)
+
+    def _streamed(self, idx, dff):
+        # True if sacd_extract writes track idx into our FIFO.  Otherwise,
+        # the converter of the FIFO is cancelled: the dff file is converted
+        if idx not in self.streams:
+            return False
+        if dff == self.fifos[idx]:
+            return True
+        logging.debug('Not streamed: ' + dff)
+        self.streams[idx].cancel()
+        return False
+
+    async def _extract(self, p, tmpdir, queue, cond):
+        # Producer: a dff file is complete once sacd_extract processes the next
+        # (tracks written into FIFOs are converted as they are extracted)
+        prev_dff = None
+        n = 0
+        async for line in progress_lines(p.stdout):
+            m = re.search(r'Processing \[(.*)\]', line.decode())
+            if not m:
+                continue
+            dff = os.path.join(tmpdir, m.group(1))
+            # sacd_extract processes the selected tracks in order
+            idx = self.tracks[n] if n < len(self.tracks) else n + 1
+            n += 1
+            if n == 1:
+                # Decoding started: create final output dir
+                outdir = self.progress.make_output_dir(
+                    self.args['rootdir'], self.metadata)
+                logging.info('To ' + outdir)
+                self.outdir.append(outdir)
+                if self.args['sacd_stream']:
+                    self._start_streams(dff, idx, outdir)
+            if prev_dff:
+                await self._enqueue(p, prev_idx, prev_dff, queue, cond)
+            prev_dff = None if self._streamed(idx, dff) else dff
+            prev_idx = idx
+        await p.wait()
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, 'sacd_extract')
+        # Transcode final dff
+        if prev_dff:
+            await self._enqueue(None, prev_idx, prev_dff, queue, cond)
+
+    async def _join(self, queue):
+        await queue.join()
+        await asyncio.gather(*self.streams.values())
+
+    async def _watch(self, coro, tasks):
+        # Awaits coro, failing as soon as a converter or a stream fails
+        task = asyncio.ensure_future(coro)
+        try:
+            while not task.done():
+                # converters never complete unless they fail
+                done, pending = await asyncio.wait(
+                    tasks + [t for t in self.streams.values()
+                             if not t.done()] + [task],
+                    return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    t.result()
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _transcode_iso(self, cmd, tmpdir):
+        # Extraction and conversions run at the same time
+        self.pending = 0
+        self.pending_size = 0
+        self.tmpspace = self._tmpspace(tmpdir)
+        self.fifos = {}
+        self.streams = {}
+        queue = asyncio.Queue()
+        cond = asyncio.Condition()
+        p = await measured_exec(
+            *cmd, stdout=subprocess.PIPE, cwd=tmpdir)
+        tasks = [asyncio.ensure_future(self._convert(queue, cond))
+                 for i in range(max(1, self.args['pipelines']))]
+        try:
+            await self._watch(self._extract(p, tmpdir, queue, cond), tasks)
+            await self._watch(self._join(queue), tasks)
+        finally:
+            if p.returncode is None:
+                p.kill()
+                p.send_signal(signal.SIGCONT)
+                await p.wait()
+            for t in tasks + list(self.streams.values()):
+                t.cancel()
+            await asyncio.gather(*tasks, *self.streams.values(),
+                                 return_exceptions=True)
+
+    def _selected_tracks(self):
+        # Tracks to extract (all of them if empty)
+        if self.args['t']:
+            tracks = sorted([int(t) for t in self.args['t']])
+        else:
+            tracks = list(range(1, len(self.titles) + 1))
+        outdir = self.progress.resumed_dir()
+        if outdir and tracks:
+            # Finish the album of an interrupted run in place
+            done = [idx for idx in tracks if self.progress.done(
+                get_filename(outdir, self._track_metadata(idx)))]
+            if self.rg:
+                # ReplayGain of the album: its finished tracks too
+                run_jobs(self.rg.missing([
+                    get_filename(outdir, self._track_metadata(idx))
+                    for idx in done]), self.args['pipelines'])
+            tracks = [idx for idx in tracks if idx not in done]
+            if not tracks:
+                return None
+        return tracks
+
+    def transcode(self, progress=None):
+        if progress is None:
+            progress = albumprogress()
+        self.progress = progress
+        self.encoder = make_encoder(self.args)
         self.outdir = []
         for f in self.files:
             isofile = os.path.join(self.directory, f)
             self._extract_metadata(isofile)
+            self.rg = albumgain() if self.args.get('replaygain') else None
+            self.tracks = self._selected_tracks()
+            if self.tracks is None:
+                # All done already
+                self.outdir.append(self.progress.make_output_dir(
+                    self.args['rootdir'], self.metadata))
+                if self.rg:
+                    self.rg.tag()
+                continue
             # Convert to DFF using sacd_extract() and parse info from log
             tmpdir = tempfile.mkdtemp()
             cmd = ['nice', 'sacd_extract', '-i', os.path.realpath(isofile), '-p', '-c']
-            if self.args['t']:
-                cmd += ['-t',','.join(self.args['t'])]
+            if self.args['t'] or len(self.tracks) < len(self.titles):
+                cmd += ['-t', ','.join([str(idx) for idx in self.tracks])]
             if self._mch():
                 cmd += ['-m']
             logging.debug(cmd)
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, cwd=tmpdir)
-            prev_dff = ''
-            idx = 0
-            for line in p.stdout:
-                m = re.search(r'Processing \[(.*)\]', line.decode())
-                if not m:
-                    continue
-                if not prev_dff:
-                    # Decoding started: create final output dir
-                    outdir = get_output_dir(self.args['rootdir'], self.metadata)
-                    os.mkdir(outdir)
-                    logging.info('To ' + outdir)
-                    self.outdir.append(outdir)
-                else:
-                    # Previous dff file is now complete
-                    dff = os.path.join(tmpdir, prev_dff)
-                    self._transcode_one(idx, dff, outdir)
-                prev_dff = m.group(1)
-                idx += 1
-            # Transcode final dff
-            dff = os.path.join(tmpdir, prev_dff)
-            self._transcode_one(idx, dff, outdir)
-            # remove intermediary directory created by sacd_extract
-            os.rmdir(os.path.dirname(dff))
-            os.rmdir(tmpdir)
+            try:
+                asyncio.run(self._transcode_iso(cmd, tmpdir))
+            finally:
+                # remove intermediary directory created by sacd_extract
+                shutil.rmtree(tmpdir, ignore_errors=True)
+            if self.rg:
+                self.rg.tag()
         return self.outdir
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     logging.info('Test 1')
 
-    args = {'srate':48000, 'rootdir':'.', 'mix':False, 'mch':True, 'gain':3}
-    t = transcoder(args)
+    args = {'srate':48000, 'rootdir':'.', 'mix':False, 'mch':True, 'gain':3,
+            't':None, 'pipelines':4, 'tmpspace':0, 'cache':False,
+            'decimate':False, 'sacd_stream':False}
+    t = sacdtranscoder(args)
     f = t.probe('testset/sacd')
     assert f, 'check testset/sacd folder for sacd iso files'
     d = t.transcode()
     assert d, 'transcode did not create output folder(s)'
-    logging.warn('DONE - Test 1. Verify ' + str(d) + ' matches testset/sacd')
+    logging.warning('DONE - Test 1. Verify ' + str(d) + ' matches testset/sacd')
@@ -0,0 +1,345 @@
+import os
+import json
+import time
+import asyncio
+import threading
+import subprocess
+import contextvars
+from plan import *
+
+# Resources used by the external commands we start: wall time, cpu time,
+# peak rss and i/o of each command (from os.wait4 and /proc, so the commands
+# are started and reaped here rather than by subprocess or asyncio).
+# A command belongs to the track set in current_track when it starts (if
+# any, see pipeline.py), and to the folder being processed (folderstats).
+
+current_track = contextvars.ContextVar('current_track', default=None)
+
+stats_lock = threading.Lock()
+stats_commands = []     # records of the commands not taken by a folderstats
+
+
+def stage_name(cmd):
+    # The program, e.g., 'sox' (flac decodes and encodes are told apart)
+    args = list(cmd)
+    while len(args) > 1 and os.path.basename(args[0]) in ('nice', 'ionice'):
+        args = args[1:]
+        while len(args) > 1 and (args[0].startswith('-') or args[0].isdigit()):
+            args = args[1:]
+    name = os.path.basename(args[0])
+    if name == 'flac' and '-d' in args:
+        name += ' -d'
+    return name
+
+
+def proc_io(pid):
+    # All the bytes read and written by pid so far, whatever they go through
+    # (any filesystem, NFS included, pipes), from /proc (Linux only)
+    try:
+        with open('/proc/%d/io' % pid) as f:
+            io = dict([line.split(':') for line in f if ':' in line])
+        return int(io['rchar']), int(io['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def wait_rusage(p):
+    # Reaps the Popen p, returns its resource usage and its i/o (see
+    # proc_io), read once it exited but before it is reaped
+    try:
+        os.waitid(os.P_PID, p.pid, os.WEXITED | os.WNOWAIT)
+        io = proc_io(p.pid)
+    except (AttributeError, OSError):
+        io = (0, 0)
+    pid, status, rusage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    return rusage, io
+
+
+def record_command(cmd, track, start, returncode, usage):
+    # read/written: all the i/o (see proc_io), block_read/written: that of
+    # block devices only (not NFS, page cache hits nor pipes)
+    rusage, (read, written) = usage
+    record = {'stage': stage_name(cmd),
+              'track': track,
+              'returncode': returncode,
+              'wall': time.monotonic() - start,
+              'user': rusage.ru_utime,
+              'system': rusage.ru_stime,
+              'maxrss': rusage.ru_maxrss * 1024,
+              'read': read,
+              'written': written,
+              'block_read': rusage.ru_inblock * 512,
+              'block_written': rusage.ru_oublock * 512}
+    with stats_lock:
+        stats_commands.append(record)
+
+
+def take_commands():
+    global stats_commands
+    with stats_lock:
+        commands, stats_commands = stats_commands, []
+    return commands
+
+
+def measured_call(cmd, **kwargs):
+    # Same as subprocess.call
+    start = time.monotonic()
+    track = current_track.get()
+    with subprocess.Popen(cmd, **kwargs) as p:
+        try:
+            usage = wait_rusage(p)
+        except BaseException:
+            p.kill()
+            usage = wait_rusage(p)
+            raise
+        finally:
+            record_command(cmd, track, start, p.returncode, usage)
+    return p.returncode
+
+
+def measured_check_output(cmd, **kwargs):
+    # Same as subprocess.check_output
+    start = time.monotonic()
+    track = current_track.get()
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, **kwargs) as p:
+        try:
+            output = p.stdout.read()
+        except BaseException:
+            p.kill()
+            raise
+        finally:
+            usage = wait_rusage(p)
+            record_command(cmd, track, start, p.returncode, usage)
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd, output)
+    return output
+
+
+class measuredprocess:
+    # What we use of asyncio.subprocess.Process.  The child is reaped by a
+    # thread of its own (as asyncio's ThreadedChildWatcher does)
+
+    def __init__(self, p, cmd, track, loop):
+        self.popen = p
+        self.pid = p.pid
+        self.returncode = None
+        self.stdin = None
+        self.stdout = None
+        self.loop = loop
+        self.exited = loop.create_future()
+        start = time.monotonic()
+        threading.Thread(target=self._reap, args=(cmd, track, start),
+                         daemon=True).start()
+
+    def _reap(self, cmd, track, start):
+        usage = wait_rusage(self.popen)
+        record_command(cmd, track, start, self.popen.returncode, usage)
+        try:
+            self.loop.call_soon_threadsafe(self._exit, self.popen.returncode)
+        except RuntimeError:
+            # event loop closed: nobody waits for us
+            self.returncode = self.popen.returncode
+
+    def _exit(self, returncode):
+        self.returncode = returncode
+        if not self.exited.done():
+            self.exited.set_result(returncode)
+
+    async def wait(self):
+        return await asyncio.shield(self.exited)
+
+    def send_signal(self, sig):
+        if self.popen.returncode is None:
+            self.popen.send_signal(sig)
+
+    def kill(self):
+        if self.popen.returncode is None:
+            self.popen.kill()
+
+
+class pipewriter(asyncio.Protocol):
+    # stdin of a measuredprocess: write(), drain() and close() as those of
+    # asyncio.StreamWriter, with the flow control of the pipe transport
+    def __init__(self, loop):
+        self.loop = loop
+        self.transport = None
+        self.paused = False
+        self.waiter = None
+        self.lost = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.lost = exc or ConnectionResetError('Connection lost')
+        self._wakeup(self.lost)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self._wakeup()
+
+    def _wakeup(self, exc=None):
+        if self.waiter and not self.waiter.done():
+            if exc:
+                self.waiter.set_exception(exc)
+            else:
+                self.waiter.set_result(None)
+        self.waiter = None
+
+    def write(self, data):
+        self.transport.write(data)
+
+    async def drain(self):
+        if self.lost:
+            raise self.lost
+        if self.transport.is_closing():
+            # e.g., the command exited: let connection_lost() tell why
+            await asyncio.sleep(0)
+            raise self.lost or ConnectionResetError('Connection lost')
+        if self.paused:
+            self.waiter = self.loop.create_future()
+            await self.waiter
+
+    def close(self):
+        self.transport.close()
+
+
+async def measured_exec(*cmd, stdin=None, stdout=None, limit=2 ** 16,
+                        track=None, **kwargs):
+    # Same as asyncio.create_subprocess_exec.  track: that of the command
+    # if not the current one
+    loop = asyncio.get_running_loop()
+    p = subprocess.Popen(cmd, stdin=stdin, stdout=stdout, **kwargs)
+    proc = measuredprocess(p, cmd, track or current_track.get(), loop)
+    try:
+        if p.stdin:
+            transport, proc.stdin = await loop.connect_write_pipe(
+                lambda: pipewriter(loop), p.stdin)
+        if p.stdout:
+            proc.stdout = asyncio.StreamReader(limit=limit, loop=loop)
+            await loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(proc.stdout, loop=loop),
+                p.stdout)
+    except BaseException:
+        proc.kill()
+        await proc.wait()
+        raise
+    return proc
+
+
+def totals(commands):
+    total = {'commands': len(commands), 'wall': 0., 'cpu': 0., 'maxrss': 0,
+             'read': 0, 'written': 0, 'block_read': 0, 'block_written': 0}
+    for c in commands:
+        total['wall'] += c['wall']
+        total['cpu'] += c['user'] + c['system']
+        total['maxrss'] = max(total['maxrss'], c['maxrss'])
+        total['read'] += c['read']
+        total['written'] += c['written']
+        total['block_read'] += c['block_read']
+        total['block_written'] += c['block_written']
+    return total
+
+
+def merge_totals(totals_list):
+    total = {'commands': 0, 'wall': 0., 'cpu': 0., 'maxrss': 0,
+             'read': 0, 'written': 0, 'block_read': 0, 'block_written': 0}
+    for t in totals_list:
+        for k in total:
+            total[k] = max(total[k], t[k]) if k == 'maxrss' else total[k] + t[k]
+    return total
+
+
+def group_totals(commands, key):
+    groups = {}
+    for c in commands:
+        if c[key] is not None:
+            groups.setdefault(c[key], []).append(c)
+    return {k: totals(v) for k, v in groups.items()}
+
+
+def files_size(pathnames):
+    return sum([os.path.getsize(p) for p in pathnames if os.path.isfile(p)])
+
+
+class folderstats:
+    # Report of the processing of one folder: its wall time, the cpu time of
+    # this process, bytes in (source files) and out (output folders), and
+    # the commands it started, by stage and by track.  A worker processes
+    # one folder at a time: all the commands started meanwhile are its own
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.index = None       # folderindex of the source, once known
+        self.outdirs = []       # output folders, once known
+        self.report = None
+
+    def __enter__(self):
+        take_commands()
+        self.start = time.monotonic()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        commands = take_commands()
+        tracks = group_totals(commands, 'track')
+        for track, total in tracks.items():
+            total['size'] = files_size([track])
+        bytes_in = 0
+        if self.index:
+            bytes_in = sum([self.index.stat(p).st_size
+                            for p in self.index.entries])
+        self.report = {
+            'folder': self.folder,
+            'wall': time.monotonic() - self.start,
+            'python_cpu': time.process_time() - self.cpu,
+            'bytes_in': bytes_in,
+            'bytes_out': sum([files_size([e.path for e in os.scandir(d)])
+                              for d in self.outdirs if os.path.isdir(d)]),
+            'commands': totals(commands),
+            'stages': group_totals(commands, 'stage'),
+            'tracks': {os.path.basename(k): v for k, v in tracks.items()}}
+        return False
+
+
+def write_stats(pathname, reports, wall):
+    stages = {}
+    for r in reports:
+        for stage, total in r['stages'].items():
+            stages.setdefault(stage, []).append(total)
+    data = {'wall': wall,
+            'stages': {stage: merge_totals(t) for stage, t in stages.items()},
+            'folders': reports}
+    with open(pathname, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    return data
+
+
+def elapsed(seconds):
+    return '%.1fs' % seconds if seconds < 60 else duration(seconds)
+
+
+def print_stats(data):
+    # data: as written by write_stats
+    folders = data['folders']
+    print('Stats: %d folders in %s, %s in, %s out, python cpu %s' % (
+        len(folders), elapsed(data['wall']),
+        size(sum([r['bytes_in'] for r in folders])),
+        size(sum([r['bytes_out'] for r in folders])),
+        elapsed(sum([r['python_cpu'] for r in folders]))))
+    print('%-14s  %5s  %8s  %8s  %4s  %9s  %9s  %9s  %9s  %9s' % (
+        'stage', 'cmds', 'wall', 'cpu', 'cpu%', 'peak rss', 'read',
+        'written', 'blk read', 'blk wrtn'))
+    for stage, t in sorted(data['stages'].items(),
+                           key=lambda x: -x[1]['wall']):
+        print('%-14s  %5d  %8s  %8s  %3d%%  %9s  %9s  %9s  %9s  %9s' % (
+            stage, t['commands'], elapsed(t['wall']), elapsed(t['cpu']),
+            100. * t['cpu'] / t['wall'] if t['wall'] else 0,
+            size(t['maxrss']), size(t['read']), size(t['written']),
+            size(t['block_read']), size(t['block_written'])))
+    for r in sorted(folders, key=lambda r: -r['wall'])[:3]:
+        print('%8s  %s' % (elapsed(r['wall']), r['folder']))
@@ -0,0 +1,295 @@
+import os
+import sys
+import math
+import array
+import random
+import hashlib
+import argparse
+import zlib
+from flacmeta import *
+
+# Deterministic fixtures for the __main__ tests of flac.py, cue.py and
+# artwork.py and for benchmark.py.  Everything is generated here, without
+# any encoder: flac files use verbatim subframes (valid, not compressed)
+#
+# testset/cd       CD quality flac album (16-bit, 44.1 kHz)
+# testset/hr       high-res flac album (24-bit, 96 kHz)
+# testset/mixed    flac files of two albums in the same folder
+# testset/cue      cue sheet + wav image
+# testset/cueflac  cue sheet + flac image
+# testset/dop      DSD over PCM flac (24-bit, 176.4 kHz)
+# testset/dff      DSD stream for dff2raw (DFF, 2.8224 MHz)
+# testset/art      artwork scans: many pictures in sub-folders + a pdf
+# (there is no generator for testset/sacd: sacd iso images)
+
+SEED = 20240101
+# All files get this mtime, so that they look the same from run to run
+MTIME = 1700000000
+BLOCK_SIZE = 4096
+
+
+# flac writer
+
+def crc8(data):
+    crc = 0
+    for b in data:
+        crc ^= b
+        for i in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xff if crc & 0x80 else crc << 1
+    return crc
+
+
+CRC16_TABLE = []
+for n in range(256):
+    crc = n << 8
+    for i in range(8):
+        crc = ((crc << 1) ^ 0x8005) & 0xffff if crc & 0x8000 else crc << 1
+    CRC16_TABLE.append(crc)
+
+
+def crc16(data):
+    crc = 0
+    table = CRC16_TABLE
+    for b in data:
+        crc = ((crc << 8) & 0xffff) ^ table[(crc >> 8) ^ b]
+    return crc
+
+
+def utf8_number(n):
+    # Frame number, coded as in UTF-8 (extended to 36 bits)
+    if n < 0x80:
+        return bytes([n])
+    data = []
+    while True:
+        data.insert(0, 0x80 | (n & 0x3f))
+        n >>= 6
+        if n < (0x40 >> len(data)):
+            break
+    lead = (0xff00 >> (len(data) + 1)) & 0xff
+    return bytes([lead | n] + data)
+
+
+def pack_samples(samples, bps, byteorder):
+    # Samples (ints) -> bytes, bps/8 bytes per sample
+    data = array.array('i', samples)
+    if sys.byteorder != 'little':
+        data.byteswap()
+    data = data.tobytes()
+    n = bps // 8
+    packed = bytearray(len(data) // 4 * n)
+    for i in range(n):
+        packed[i::n] = data[n-1-i if byteorder == 'big' else i::4]
+    return bytes(packed)
+
+
+def frame_header(n, blocksize, srate, channels, bps):
+    srate_codes = {88200: 1, 176400: 2, 192000: 3, 32000: 8, 44100: 9,
+                   48000: 10, 96000: 11}
+    bps_codes = {8: 1, 16: 4, 24: 6}
+    if blocksize == BLOCK_SIZE:
+        size_code, extra = 12, b''
+    else:
+        size_code, extra = 7, (blocksize - 1).to_bytes(2, 'big')
+    header = bytes([0xff, 0xf8, (size_code << 4) | srate_codes.get(srate, 0),
+                    ((channels - 1) << 4) | (bps_codes[bps] << 1)]) + \
+        utf8_number(n) + extra
+    return header + bytes([crc8(header)])
+
+
+def write_flac(pathname, samples, srate, channels, bps, tags):
+    # samples: array('i') of interleaved samples
+    total = len(samples) // channels
+    md5 = hashlib.md5(pack_samples(samples, bps, 'little')).digest()
+    bits = (srate << 44) | ((channels - 1) << 41) | ((bps - 1) << 36) | total
+    streaminfo = BLOCK_SIZE.to_bytes(2, 'big') * 2 + bytes(6) + \
+        bits.to_bytes(8, 'big') + md5
+    blocks = [(STREAMINFO, streaminfo),
+              (VORBIS_COMMENT, vorbis_comment('slickzik testset', tags))]
+    with open(pathname, 'wb') as f:
+        f.write(b'fLaC' + metadata_blocks(blocks, DEFAULT_PADDING))
+        for n, start in enumerate(range(0, total, BLOCK_SIZE)):
+            blocksize = min(BLOCK_SIZE, total - start)
+            frame = [frame_header(n, blocksize, srate, channels, bps)]
+            for ch in range(channels):
+                # VERBATIM subframe
+                frame += [b'\x02', pack_samples(
+                    samples[start*channels+ch:(start+blocksize)*channels:
+                            channels], bps, 'big')]
+            frame = b''.join(frame)
+            f.write(frame + crc16(frame).to_bytes(2, 'big'))
+
+
+# other formats
+
+def write_wav(pathname, samples, srate, channels, bps):
+    data = pack_samples(samples, bps, 'little')
+    fmt = (1).to_bytes(2, 'little') + channels.to_bytes(2, 'little') + \
+        srate.to_bytes(4, 'little') + \
+        (srate * channels * bps // 8).to_bytes(4, 'little') + \
+        (channels * bps // 8).to_bytes(2, 'little') + bps.to_bytes(2, 'little')
+    with open(pathname, 'wb') as f:
+        f.write(b'RIFF' + (4 + 8 + len(fmt) + 8 + len(data)).to_bytes(4, 'little')
+                + b'WAVE' + b'fmt ' + len(fmt).to_bytes(4, 'little') + fmt +
+                b'data' + len(data).to_bytes(4, 'little') + data)
+
+
+def dff_chunk(ckid, data):
+    return ckid + len(data).to_bytes(8, 'big') + data
+
+
+def write_dff(pathname, dsd, channels, srate=2822400):
+    prop = b'SND ' + dff_chunk(b'FS  ', srate.to_bytes(4, 'big')) + \
+        dff_chunk(b'CHNL', channels.to_bytes(2, 'big') + b'SLFTSRGT') + \
+        dff_chunk(b'CMPR', b'DSD \x0enot compressed\x00')
+    header = b'DSD ' + dff_chunk(b'FVER', bytes([1, 5, 0, 0])) + \
+        dff_chunk(b'PROP', prop)
+    with open(pathname, 'wb') as f:
+        f.write(b'FRM8' + (len(header) + 12 + len(dsd)).to_bytes(8, 'big') +
+                header + dff_chunk(b'DSD ', dsd))
+
+
+def png_chunk(type, data):
+    return len(data).to_bytes(4, 'big') + type + data + \
+        zlib.crc32(type + data).to_bytes(4, 'big')
+
+
+def write_png(pathname, width, height, color):
+    row = b'\x00' + bytes(color) * width
+    with open(pathname, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' +
+                png_chunk(b'IHDR', width.to_bytes(4, 'big') +
+                          height.to_bytes(4, 'big') + bytes([8, 2, 0, 0, 0])) +
+                png_chunk(b'IDAT', zlib.compress(row * height)) +
+                png_chunk(b'IEND', b''))
+
+
+def write_bmp(pathname, width, height, color):
+    row = bytes(color[::-1]) * width
+    row += bytes(-len(row) % 4)
+    info = (40).to_bytes(4, 'little') + width.to_bytes(4, 'little') + \
+        height.to_bytes(4, 'little') + (1).to_bytes(2, 'little') + \
+        (24).to_bytes(2, 'little') + bytes(24)
+    with open(pathname, 'wb') as f:
+        f.write(b'BM' + (14 + 40 + len(row) * height).to_bytes(4, 'little') +
+                bytes(4) + (14 + 40).to_bytes(4, 'little') + info +
+                row * height)
+
+
+# signals
+
+def tone(srate, seconds, channels, bps, freqs):
+    # One tone per channel at -6 dB.  freqs should divide srate, so that a
+    # single period is computed and repeated
+    total = int(srate * seconds)
+    amplitude = (1 << (bps - 2)) - 1
+    samples = array.array('i', bytes(4 * total * channels))
+    for ch in range(channels):
+        period = srate // freqs[ch % len(freqs)]
+        cycle = array.array('i', [
+            int(amplitude * math.sin(2 * math.pi * k / period))
+            for k in range(period)])
+        cycle *= total // period + 1
+        samples[ch::channels] = cycle[:total]
+    return samples
+
+
+def dop(srate, seconds, channels, rng):
+    # 16 DSD bits per sample, after alternating 0x05/0xfa markers
+    total = int(srate * seconds)
+    samples = array.array('i', bytes(4 * total * channels))
+    for ch in range(channels):
+        samples[ch::channels] = array.array('i', [
+            (0xfa << 16 | rng.getrandbits(16)) - (1 << 24) if k & 1 else
+            0x05 << 16 | rng.getrandbits(16)
+            for k in range(total)])
+    return samples
+
+
+# fixtures
+
+def album_tags(album, artist, date, number, title):
+    return [('ALBUM', album), ('ARTIST', artist), ('DATE', date),
+            ('TRACKNUMBER', str(number)), ('TITLE', title)]
+
+
+def flac_album(folder, album, tracks, srate, bps, seconds, first=1):
+    for i, title in enumerate(tracks):
+        number = first + i
+        samples = tone(srate, seconds, 2, bps, (441 * number, 882 * number))
+        write_flac(os.path.join(folder, '%02d %s.flac' % (number, title)),
+                   samples, srate, 2, bps,
+                   album_tags(album, 'Testset Artist', '1999', number, title))
+
+
+def cue_sheet(image, titles, seconds):
+    lines = ['REM DATE 2001', 'PERFORMER "Testset Artist"',
+             'TITLE "Cue Album"', 'FILE "%s" WAVE' % image]
+    for i, title in enumerate(titles):
+        frames = i * seconds * 75
+        lines += ['  TRACK %02d AUDIO' % (i + 1), '    TITLE "%s"' % title,
+                  '    INDEX 01 %02d:%02d:%02d' % (
+                      frames // 75 // 60, frames // 75 % 60, frames % 75)]
+    return '\n'.join(lines) + '\n'
+
+
+def generate(testset, seconds):
+    rng = random.Random(SEED)
+    folders = {}
+    for name in ('cd', 'hr', 'mixed', 'cue', 'cueflac', 'dop', 'dff', 'art'):
+        folders[name] = os.path.join(testset, name)
+        os.makedirs(folders[name], exist_ok=True)
+
+    flac_album(folders['cd'], 'CD Album', ('One', 'Two', 'Three'),
+               44100, 16, seconds)
+    write_png(os.path.join(folders['cd'], 'folder.png'), 500, 500, (40, 80, 160))
+    flac_album(folders['hr'], 'Hires Album', ('Alpha', 'Beta'),
+               96000, 24, seconds / 2)
+    flac_album(folders['mixed'], 'First Album', ('A1', 'A2'), 44100, 16,
+               seconds / 4)
+    flac_album(folders['mixed'], 'Second Album', ('B1', 'B2'), 44100, 16,
+               seconds / 4, first=3)
+
+    titles = ('Intro', 'Middle', 'Outro')
+    image = tone(44100, seconds * len(titles), 2, 16, (441, 630))
+    write_wav(os.path.join(folders['cue'], 'image.wav'), image, 44100, 2, 16)
+    with open(os.path.join(folders['cue'], 'image.cue'), 'w') as f:
+        f.write(cue_sheet('image.wav', titles, seconds))
+    write_flac(os.path.join(folders['cueflac'], 'image.flac'), image,
+               44100, 2, 16, [])
+    with open(os.path.join(folders['cueflac'], 'image.cue'), 'w') as f:
+        f.write(cue_sheet('image.flac', titles, seconds))
+
+    write_flac(os.path.join(folders['dop'], '01 Dop.flac'),
+               dop(176400, seconds / 4, 2, rng), 176400, 2, 24,
+               album_tags('Dop Album', 'Testset Artist', '2010', 1, 'Dop'))
+    write_dff(os.path.join(folders['dff'], 'stereo.dff'),
+              rng.randbytes(2822400 // 8 * 2 * int(seconds)), 2)
+
+    # Scans: 10 sub-folders of 20 pictures, a cover, a booklet
+    write_png(os.path.join(folders['art'], 'cover.png'), 700, 700, (200, 30, 30))
+    write_bmp(os.path.join(folders['art'], 'back.bmp'), 800, 400, (30, 200, 30))
+    for i in range(10):
+        subdir = os.path.join(folders['art'], 'scans', 'disc%d' % i)
+        os.makedirs(subdir, exist_ok=True)
+        for j in range(20):
+            write_png(os.path.join(subdir, 'page%02d.png' % j),
+                      rng.randrange(100, 1200), rng.randrange(100, 1200),
+                      (i * 20, j * 10, 100))
+    with open(os.path.join(folders['art'], 'booklet.pdf'), 'wb') as f:
+        f.write(b'%PDF-1.4\n%%EOF\n')
+
+    for root, dirs, files in os.walk(testset):
+        for name in files:
+            os.utime(os.path.join(root, name), (MTIME, MTIME))
+    return folders
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate the test and benchmark fixtures')
+    parser.add_argument('testset', nargs='?', default='testset')
+    parser.add_argument('-s', '--seconds', type=int, default=20,
+                        help='length of a cd track (others are scaled)')
+    args = parser.parse_args()
+    for name, folder in sorted(generate(args.testset, args.seconds).items()):
+        print(folder)
@@ -0,0 +1,259 @@
+import os
+import time
+import errno
+import select
+import struct
+import sqlite3
+import logging
+import ctypes
+import ctypes.util
+from folderindex import *
+
+QUEUE_NAME = '.slickzik-queue.db'
+RENAMED_PREFIXES = ('0K-', '0C-')     # see finish_folder (-r/--rename)
+
+# inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_CHANGES = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+
+class inotify:
+    # The inotify calls of the C library, through ctypes.  Raises OSError
+    # where there is no inotify (not Linux)
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify not available')
+        self.fd = self._check(self.libc.inotify_init1(IN_NONBLOCK |
+                                                      IN_CLOEXEC))
+
+    def _check(self, ret, pathname=None):
+        if ret < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), pathname)
+        return ret
+
+    def add_watch(self, pathname, mask):
+        return self._check(self.libc.inotify_add_watch(
+            self.fd, os.fsencode(pathname), mask), pathname)
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        # Events (wd, mask, name) received within timeout seconds
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        i = 0
+        while i + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, i)
+            name = data[i + 16:i + 16 + length].rstrip(b'\0')
+            events.append((wd, mask, os.fsdecode(name)))
+            i += 16 + length
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class dropwatcher:
+    # Album folders dropped (copied or moved) into a directory.  A folder is
+    # ready once its files have stopped changing for settle seconds: the
+    # fingerprint of its tree (see folderindex.py) is the same and, with
+    # inotify, none of its directories had an event meanwhile.  Without
+    # inotify, the directory is listed at every poll and only the folders
+    # not ready yet are scanned.  Folders already renamed by -r are ignored
+
+    def __init__(self, directory, settle=5):
+        self.directory = os.path.realpath(directory)
+        self.settle = settle
+        self.drops = {}     # folder -> [fingerprint, stable since, ready]
+        self.mtimes = {}    # folder -> mtime (polling only)
+        self.wds = {}       # watch descriptor -> folder, directory watched
+        try:
+            self.inotify = inotify()
+            self.inotify.add_watch(self.directory, IN_CREATE | IN_MOVED_TO |
+                                   IN_MOVED_FROM | IN_DELETE | IN_Q_OVERFLOW)
+            logging.info('Watching %s (inotify)' % self.directory)
+        except OSError as e:
+            self.inotify = None
+            logging.info('Watching %s (polling: %s)' % (self.directory, e))
+        self._list()
+
+    def _is_drop(self, name):
+        return not name.startswith(('.',) + RENAMED_PREFIXES) and \
+            os.path.isdir(os.path.join(self.directory, name))
+
+    def _list(self):
+        # The folders of the directory (new ones are not ready yet)
+        names = set([name for name in os.listdir(self.directory)
+                     if self._is_drop(name)])
+        for name in names:
+            folder = os.path.join(self.directory, name)
+            if folder not in self.drops:
+                self._add(folder)
+            elif self.inotify is None and self.drops[folder][2]:
+                # ready ones are not scanned any more: new files in them?
+                if os.stat(folder).st_mtime_ns != self.mtimes.get(folder):
+                    self._changed(folder)
+        for folder in list(self.drops):
+            if os.path.basename(folder) not in names:
+                self._remove(folder)
+
+    def _add(self, folder):
+        self.drops[folder] = [None, time.monotonic(), False]
+        if self.inotify:
+            self._watch_tree(folder, folder)
+
+    def _watch_tree(self, folder, directory):
+        try:
+            wd = self.inotify.add_watch(directory, IN_CHANGES)
+            self.wds[wd] = (folder, directory)
+            for entry in os.scandir(directory):
+                if entry.is_dir(follow_symlinks=False):
+                    self._watch_tree(folder, entry.path)
+        except OSError as e:
+            # e.g., gone already, or out of watches: rely on the fingerprint
+            logging.debug('Not watching %s: %s' % (directory, e))
+
+    def _remove(self, folder):
+        del self.drops[folder]
+        self.mtimes.pop(folder, None)
+        for wd in [wd for wd, w in self.wds.items() if w[0] == folder]:
+            del self.wds[wd]
+            self.inotify.rm_watch(wd)
+
+    def _changed(self, folder):
+        drop = self.drops[folder]
+        drop[1] = time.monotonic()
+        drop[2] = False
+
+    def _events(self, timeout):
+        # All the events within timeout seconds (a copy makes many of them)
+        deadline = time.monotonic() + timeout
+        events = []
+        while time.monotonic() < deadline:
+            events += self.inotify.read(deadline - time.monotonic())
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # events lost: start over
+                for folder in list(self.drops):
+                    self._remove(folder)
+                self._list()
+            elif wd in self.wds:
+                folder, directory = self.wds[wd]
+                if mask & IN_IGNORED:
+                    del self.wds[wd]
+                elif folder in self.drops:
+                    self._changed(folder)
+                    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                        self._watch_tree(folder, os.path.join(directory,
+                                                              name))
+            elif name:
+                # in the directory itself
+                folder = os.path.join(self.directory, name)
+                if mask & (IN_CREATE | IN_MOVED_TO) and self._is_drop(name):
+                    if folder not in self.drops:
+                        self._add(folder)
+                elif mask & (IN_MOVED_FROM | IN_DELETE) and \
+                        folder in self.drops:
+                    self._remove(folder)
+
+    def poll(self, timeout=1):
+        # Waits up to timeout seconds.  Returns the folders that got ready
+        # with their fingerprint
+        if self.inotify:
+            self._events(timeout)
+        else:
+            time.sleep(timeout)
+            self._list()
+        ready = []
+        now = time.monotonic()
+        for folder, drop in self.drops.items():
+            if drop[2] or now - drop[1] < min(1, self.settle):
+                continue
+            try:
+                index = folderindex(folder)
+                fingerprint = index.fingerprint()
+            except OSError:
+                continue
+            if fingerprint != drop[0]:
+                drop[0] = fingerprint
+                drop[1] = now
+            elif now - drop[1] >= self.settle and index.entries:
+                drop[2] = True
+                if self.inotify is None:
+                    self.mtimes[folder] = os.stat(folder).st_mtime_ns
+                ready.append((folder, fingerprint))
+        return ready
+
+
+class dropqueue:
+    # Persistent queue of the ready folders (in rootdir, next to the
+    # manifest), so that a restart picks up where the last run stopped:
+    # folders queued or being processed then are queued again, as are those
+    # that failed, and those processed are not, as long as their files are
+    # the same
+
+    def __init__(self, rootdir):
+        self.pathname = os.path.join(rootdir, QUEUE_NAME)
+        self.db = sqlite3.connect(self.pathname, timeout=60)
+        with self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS queue (
+                            folder TEXT PRIMARY KEY, fingerprint TEXT,
+                            state TEXT, added REAL)''')
+            self.db.execute('''UPDATE queue SET state='queued'
+                            WHERE state IN ('running', 'failed')''')
+
+    def push(self, folder, fingerprint):
+        # False if already processed (or failed) with these files
+        row = self.db.execute('SELECT fingerprint, state FROM queue '
+                              'WHERE folder=?', (folder,)).fetchone()
+        if row and row[0] == fingerprint:
+            return False
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO queue VALUES(?,?,?,?)',
+                            (folder, fingerprint, 'queued', time.time()))
+        return True
+
+    def pop(self):
+        # The oldest folder queued (now running), or None
+        row = self.db.execute('SELECT folder FROM queue WHERE state=? '
+                              'ORDER BY added LIMIT 1',
+                              ('queued',)).fetchone()
+        if row is None:
+            return None
+        self.set_state(row[0], 'running')
+        return row[0]
+
+    def set_state(self, folder, state):
+        with self.db:
+            self.db.execute('UPDATE queue SET state=? WHERE folder=?',
+                            (state, folder))
+
+    def remove(self, folder):
+        # e.g., renamed once processed
+        with self.db:
+            self.db.execute('DELETE FROM queue WHERE folder=?', (folder,))
+
+    def count(self, state):
+        return self.db.execute('SELECT COUNT(*) FROM queue WHERE state=?',
+                               (state,)).fetchone()[0]